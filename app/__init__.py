@@ -48,6 +48,9 @@ def create_app(configuration='default'):
     app.register_blueprint(strava.strava, url_prefix='/strava')
     app.register_blueprint(admin.admin, url_prefix='/admin')
 
+    if app.config.get('NUMBA_WARMUP'):
+        report_warmup(app.logger.info)
+
     @app.cli.command()
     def initdb():
         # call "flask initdb" to initialized the database
@@ -55,9 +58,135 @@ def create_app(configuration='default'):
         print('Initializing the database.')
         db.create_all()
 
+    @app.cli.command("build-routes")
+    def build_routes():
+        # call "flask build-routes" at deploy to precompile the routes
+        import app.analysis as analysis
+        print('Building the route store.')
+        analysis.build_route_store()
+
+    @app.cli.command("build-exports")
+    @click.option("--geobuf", is_flag=True,
+                  help="geobuf versions of the geojson exports too "
+                       "(loads each one whole, and needs "
+                       "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python)")
+    def build_exports(geobuf):
+        # call "flask build-exports" at deploy to compress and hash
+        # the map files that are already there
+        import os
+        from app.api import EXPORTS, export_path
+        from app.utils import write_variants, update_manifest
+        for name in EXPORTS:
+            filepath = export_path(name)
+            if os.path.exists(filepath):
+                write_variants(filepath, geobuf=geobuf and
+                               filepath.endswith('.geojson'))
+                print(f'{name}: {update_manifest(name, filepath)}')
+
+    @app.cli.command("warmup")
+    def warmup():
+        # call "flask warmup" at deploy to compile the numba kernels
+        # into their on disk cache
+        report_warmup(print)
+
+    @app.cli.command("analyze-worker")
+    @click.option("--batch-size", default=10, show_default=True,
+                  help="activities per commit")
+    @click.option("--max-batches", type=int, default=None,
+                  help="stop after this many batches")
+    @click.option("--sleep", type=float, default=0,
+                  help="keep polling the queue, this many seconds apart")
+    def analyze_worker(batch_size, max_batches, sleep):
+        # call "flask analyze-worker" to analyze the queued activities
+        import time
+        import app.activities as activities
+        while True:
+            res = activities.analyze_queue(batch_size=batch_size,
+                                           max_batches=max_batches)
+            if res['batches']:
+                print(f"Analyzed {res['done']} activities, "
+                      f"{res['failed']} failed.")
+            if not sleep:
+                break
+            time.sleep(sleep)
+
+    @app.cli.command("analyze-all")
+    @click.option("--new", is_flag=True,
+                  help="only the activities without an analysis")
+    @click.option("--processes", type=int, default=None,
+                  help="worker processes (default is one per core)")
+    def analyze_all(new, processes):
+        # call "flask analyze-all" to reanalyze everything,
+        # after the routes change
+        import app.activities as activities
+        res = activities.analyze_all(all=not new, processes=processes)
+        print(f"Analyzed {res['done']} activities, {res['failed']} failed.")
+
+    @app.cli.command("event-worker")
+    @click.option("--batch-size", default=20, show_default=True,
+                  help="activities (bursts of events) per commit")
+    @click.option("--sleep", type=float, default=0,
+                  help="keep polling for events, this many seconds apart")
+    @click.option("--window", type=float, default=None,
+                  help="seconds an activity must be quiet before its "
+                       "events are handled (default EVENT_COALESCE_WINDOW)")
+    def event_worker(batch_size, sleep, window):
+        # call "flask event-worker" to handle the webhook events
+        import time
+        while True:
+            res = strava.process_pending_events(batch_size=batch_size,
+                                                window=window)
+            if res['batches']:
+                print(f"Processed {res['done']} events "
+                      f"({res['coalesced']} more coalesced), "
+                      f"{res['failed']} failed. {strava.event_metrics()}")
+            if res['retry_after']:
+                print(f"Out of Strava budget for {res['retry_after']:.0f}s.")
+            if not sleep:
+                break
+            time.sleep(max(sleep, res['retry_after'] or 0))
+
+    @app.cli.command("backfill")
+    @click.option("--athlete", "athletes", type=int, multiple=True,
+                  help="just this athlete (can be repeated)")
+    @click.option("--concurrency", default=8, show_default=True,
+                  help="strava requests at once")
+    @click.option("--batch-size", default=50, show_default=True,
+                  help="activities per commit")
+    @click.option("--before", type=int, default=None,
+                  help="only activities before this (epoch seconds)")
+    @click.option("--after", type=int, default=None,
+                  help="only activities after this (epoch seconds)")
+    def backfill(athletes, concurrency, batch_size, before, after):
+        # call "flask backfill" to get all the woc activities of every
+        # athlete from strava, that we don't have already
+        from app.backfill import backfill
+        res = backfill(athletes, concurrency=concurrency,
+                       batch_size=batch_size, before=before, after=after)
+        print(f"Saved {res['saved']} activities of {res['athletes']} "
+              f"athletes in {res['seconds']}s, {res['failed']} failed, "
+              f"{res['rate_limited']} rate limited.")
+
+    @app.cli.command("rebuild-stats")
+    def rebuild_stats():
+        # call "flask rebuild-stats" to count the dashboard totals again
+        from app.stats import rebuild
+        res = rebuild()
+        print(f"{res['activities']} activities of {res['athletes']} "
+              f"athletes, {res['days']} days, {res['routes']} routes.")
+
     @app.cli.command("webhook-reset")
     @click.argument("subscription_id")
     def webhook_reset(subscription_id):
         strava.delete_subscription(subscription_id)
 
     return app
+
+
+def report_warmup(log):
+    # compile the analysis kernels and report how long it took
+    import app.analysis as analysis
+    timings = analysis.warmup()
+    for name, seconds in timings.items():
+        log(f'  {name}: {seconds:.2f} s')
+    log(f'Numba warmup took {sum(timings.values()):.2f} s')
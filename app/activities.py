@@ -1,16 +1,22 @@
+import time
+import calendar
 from datetime import datetime
 from flask import current_app
 
 import geojson
-# import geobuf
+import sqlalchemy as sa
 
-from sqlalchemy.orm import lazyload, joinedload
-from app.models import (db, Athlete, Activity, get_or_create,
-                        Point, Tag, StravaEvent)
-from app.utils import hashtags
+from sqlalchemy.orm import (lazyload, joinedload, load_only, selectinload,
+                            undefer, undefer_group)
+from app.models import (db, Athlete, Activity, upsert, act_tag_assoc_table,
+                        Tag, StravaEvent, AnalysisJob, ActivityArtifact)
+from app.utils import (hashtags, write_atomic, write_variants,
+                       update_manifest, export_name)
 
-import app.auth as auth
+import app.strava_client as strava_client
+import app.ratelimit as ratelimit
 import app.analysis as analysis
+import app.stats as stats
 from authlib.integrations.base_client import (InvalidTokenError,
                                               UnsupportedTokenTypeError)
 
@@ -19,31 +25,97 @@ from authlib.integrations.base_client import (InvalidTokenError,
 # these are the drones we are looking for
 woctags = set(['wocblm', 'blmwoc', 'blm', 'woc'])
 
-
-def process_range(first=None, last=None, max_events=100):
-    # process a range of events.
-    # works well as long as no one "commits"
-    # but it's ok.. we can "flush" after an event
-
-    events = StravaEvent.query
+# bump this when the map features or heat points change,
+# so refresh_artifacts remakes them all
+ARTIFACT_VERSION = 1
+
+
+def process_range(first=None, last=None, max_events=100, chunk_size=20):
+    """
+    Replay the webhook events from last back to first (event ids), at
+    most max_events of them, say after an outage.  the events are loaded
+    at once and only the newest one that matters for each activity is
+    kept, the activities we already have (newer than the event) are
+    skipped with one query, and the rest are fetched from strava and
+    saved a chunk at a time.  the work is proportional to the activities,
+    not the events.
+
+    it is a backfill, so it stops when the rate limit budget for backfills
+    runs out (and says when to try again).  "next" is the last to give
+    the next call to carry on, None when there are no more events.
+    """
+    max_events = int(max_events)
+    events = db.session.query(
+        StravaEvent._id, StravaEvent.object_id, StravaEvent.owner_id,
+        StravaEvent.aspect_type, StravaEvent.event_time,
+        StravaEvent.updates).filter(StravaEvent.object_type == 'activity')
     if first:
         events = events.filter(StravaEvent._id >= int(first))
     if last:
         events = events.filter(StravaEvent._id <= int(last))
-
-    events = events.order_by(StravaEvent._id.desc())
-
-    i = 0
-    for event in events:
-        if i == 0:
-            last = event._id
-        process_event(event, commit=False)
-        i = i+1
-        if i >= int(max_events):
-            first = event._id
-            break
-    db.session.commit()
-    return dict(first=first, last=last)
+    events = events.order_by(StravaEvent._id.desc()).limit(max_events).all()
+    if not events:
+        return dict(first=first, last=last, events=0, next=None)
+
+    # newest first, so the first one that matters for an activity wins.
+    # create events fetch the activity if we don't have it, updates
+    # if they add a woc tag and we haven't saved it since
+    wanted = {}
+    for ev in events:
+        if ev.object_id in wanted:
+            continue
+        if ev.aspect_type == 'create' or (
+                ev.aspect_type == 'update' and
+                hashtags(ev.updates).intersection(woctags)):
+            wanted[ev.object_id] = ev
+
+    saved = dict(db.session.query(Activity._id, Activity.last_updated)
+                 .filter(Activity._id.in_(list(wanted))))
+    todo = []
+    for ev in wanted.values():
+        updated = saved.get(ev.object_id)
+        if updated is None:
+            todo.append(ev)
+        elif (ev.aspect_type == 'update' and
+              calendar.timegm(updated.utctimetuple()) <=
+              (ev.event_time or 0)):
+            # changed on strava since we saved it (last_updated is utc,
+            # not server time)
+            todo.append(ev)
+
+    result = dict(first=events[-1]._id, last=events[0]._id,
+                  events=len(events), activities=len(wanted),
+                  fetched=0, saved=0,
+                  next=(events[-1]._id - 1 if len(events) == max_events
+                        else None))
+
+    athletes = {a._id: a for a in Athlete.query.filter(
+        Athlete._id.in_(set(ev.owner_id for ev in todo)))}
+    with ratelimit.priority(ratelimit.BACKFILL):
+        for i in range(0, len(todo), int(chunk_size)):
+            chunk = todo[i:i + int(chunk_size)]
+            batch = []
+            try:
+                for ev in chunk:
+                    data = fetch_activity(ev.object_id,
+                                          athletes.get(ev.owner_id))
+                    result['fetched'] += 1
+                    if not isinstance(data, str) and is_woc(data):
+                        batch.append((data, ev.owner_id))
+            except ratelimit.RateLimited as e:
+                # keep what was fetched, the next call starts at the event
+                # that was not (the ones done since are skipped then)
+                store_activities(batch)
+                db.session.commit()
+                result['saved'] += len(batch)
+                result['next'] = ev._id
+                result['retry_after'] = e.retry_after
+                return result
+            store_activities(batch)
+            db.session.commit()
+            result['saved'] += len(batch)
+
+    return result
 
 
 def process_event_id(event_id):
@@ -52,7 +124,8 @@ def process_event_id(event_id):
     if not ev:
         current_app.logger.debug(f"Couldn't find event {event_id}")
         return f"No event {event_id}"
-    return process_event(ev)
+    with ratelimit.priority(ratelimit.BACKFILL):
+        return process_event(ev)
 
 
 def process_event(ev, commit=True):
@@ -92,9 +165,12 @@ def process_athletes(page=1, before=None, after=None, per_page=100):
                                                       per_page=int(per_page))
     except (TypeError, ValueError):
         return 'Error', 400
-    for athlete in athletes.items:
-        process_athlete(athlete,  before=before, after=after)
-    db.session.commit()
+    try:
+        for athlete in athletes.items:
+            process_athlete(athlete,  before=before, after=after)
+    finally:
+        # keep what was done before running out of budget
+        db.session.commit()
     return 'Done'
 
 
@@ -116,7 +192,8 @@ def process_athlete(athlete, before=None, after=None):
     auth_token = athlete.auth_token
 
     try:
-        resp = auth.oauth.strava.request('GET', 'athlete/activities',
+        with ratelimit.priority(ratelimit.BACKFILL):
+            resp = strava_client.request('GET', 'athlete/activities',
                                          token=auth_token, params=params)
     except (UnsupportedTokenTypeError, InvalidTokenError):
         current_app.logger.info(
@@ -131,13 +208,12 @@ def process_athlete(athlete, before=None, after=None):
 
     activity_summaries = resp.json()
 
-    for summary in activity_summaries:
-        tags = (hashtags(summary['name'])
-                .union(hashtags(summary.get('description'))))
-        if tags.intersection(woctags):
-            if not Activity.query.get(summary['id']):
-                save_activity(summary['id'], athlete, commit=False,
-                              filter_for_tags=False)
+    with ratelimit.priority(ratelimit.BACKFILL):
+        for summary in activity_summaries:
+            if is_woc(summary):
+                if not Activity.query.get(summary['id']):
+                    save_activity(summary['id'], athlete, commit=False,
+                                  filter_for_tags=False)
 
     return 'Done'
 
@@ -148,7 +224,8 @@ def save_activity(activity_id, owner, timestamp=None, commit=True,
 
     if timestamp:
         act = Activity.query.get(activity_id)
-        if act and act.last_updated.timestamp() > timestamp:
+        if act and (calendar.timegm(act.last_updated.utctimetuple()) >
+                    timestamp):
             current_app.logger.debug("Activity already saved since timestamp.")
 
             # already updated
@@ -159,17 +236,39 @@ def save_activity(activity_id, owner, timestamp=None, commit=True,
     else:
         athlete = owner
 
+    data = fetch_activity(activity_id, athlete)
+    if isinstance(data, str):
+        return data
+
+    if filter_for_tags and not is_woc(data):
+        current_app.logger.info(f'Activity: {activity_id}; '
+                                f'had no matching hashtag: {data["name"]}')
+        return "Not a WOC activity."
+
+    store_activities([(data, athlete._id)])
+    activity = db.session.get(Activity, data['id'])
+
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+    return activity
+
+
+def fetch_activity(activity_id, athlete):
+    # the activity data from strava, or what went wrong (a string)
     auth_token = athlete.auth_token if athlete else None
     if not auth_token:
         current_app.logger.info(
-            f'Activity: {activity_id}; no auth for {athlete._id}: {athlete}')
+            f'Activity: {activity_id}; no auth for {athlete!r}')
         return "No auth token."
 
     # params = {'include_all_efforts': False}
     params = None   # this returns less efforts
     try:
-        resp = auth.oauth.strava.request('GET', f'activities/{activity_id}',
-                                         token=auth_token, params=params)
+        resp = strava_client.request('GET', f'activities/{activity_id}',
+                                     token=auth_token, params=params)
     except InvalidTokenError:
         current_app.logger.info(
             f'Activity: {activity_id}; failed to GET: InvalidTokenError!')
@@ -185,16 +284,27 @@ def save_activity(activity_id, owner, timestamp=None, commit=True,
     current_app.logger.debug(f"Got activity {activity_id} from STRAVA:"
                              f" {data['name']}")
     # current_app.logger.debug(f"efforts {len(data['segment_efforts'])}")
+    return data
 
-    if filter_for_tags:
-        tags = hashtags(data['name']).union(hashtags(data.get('description')))
-        if not tags.intersection(woctags):
-            current_app.logger.info(f'Activity: {activity_id}; '
-                                    f'had no matching hashtag: {data["name"]}')
-            return "Not a WOC activity."
 
-    activity, created = get_or_create(Activity, _id=data['id'])
+def is_woc(data):
+    # activity data (or a summary) with one of our hashtags
+    tags = hashtags(data['name']).union(hashtags(data.get('description')))
+    return bool(tags.intersection(woctags))
 
+
+def store_activities(items):
+    """
+    Save a batch of (activity data from strava, athlete id) to the
+    database (not committed).  the activities, their tags and analysis
+    jobs are upserts, and the tag links are replaced, so it is the same
+    handful of statements for one activity or a thousand.
+    """
+    if not items:
+        return []
+    # anything the session has for these goes in first
+    db.session.flush()
+    now = datetime.utcnow()
     save_keys = ["name",
                  "description",
                  "elapsed_time",
@@ -207,49 +317,78 @@ def save_activity(activity_id, owner, timestamp=None, commit=True,
                  "private",
                  "flagged"]
 
-    for attr in save_keys:
-        setattr(activity, attr, data.get(attr))
-
-    activity.start_date = datetime.strptime(data['start_date'],
-                                            "%Y-%m-%dT%H:%M:%SZ")
-    activity.map_polyline = data["map"].get("polyline")
-    activity.map_summary_polyline = data["map"].get("summary_polyline")
-    if data.get('start_latlng'):
-        activity.start_latlon = Point(*data['start_latlng'])
-    if data.get('end_latlng'):
-        activity.end_latlon = Point(*data['end_latlng'])
-    activity.activity_type = data['type']
-
-    activity.athlete = athlete
-
-    activity.details = data
-
-    htags = hashtags(data['name']).union(hashtags(data.get('description')))
-    current_app.logger.debug(f'tags {htags}')
-    for hashtag in htags:
-        tag, _ = get_or_create(Tag, _id=hashtag)
-        activity.tags.append(tag)
-
-    if commit:
-        db.session.commit()
-    else:
-        db.session.flush()
-
-    return activity
+    rows, links = {}, {}
+    for data, athlete_id in items:
+        row = {attr: data.get(attr) for attr in save_keys}
+        start = data.get('start_latlng') or (None, None)
+        end = data.get('end_latlng') or (None, None)
+        row.update({
+            '_id': data['id'],
+            'athlete_id': athlete_id,
+            'start_date': datetime.strptime(data['start_date'],
+                                            "%Y-%m-%dT%H:%M:%SZ"),
+            'map_polyline': data["map"].get("polyline"),
+            'map_summary_polyline': data["map"].get("summary_polyline"),
+            'start_lat': start[0], 'start_lon': start[1],
+            'end_lat': end[0], 'end_lon': end[1],
+            'activity_type': data['type'],
+            'details': data,
+            'last_updated': now,
+        })
+        # the last one wins if an activity is in the batch twice
+        rows[data['id']] = row
+        links[data['id']] = (hashtags(data['name'])
+                             .union(hashtags(data.get('description'))))
+    ids = list(rows)
+    cols = [c for c in rows[ids[0]] if c != '_id']
+    # what the dashboard totals will change by, from what is there now
+    deltas = stats.stored_deltas(rows)
+
+    upsert(Activity, list(rows.values()), update=cols,
+           keep=['start_lat', 'start_lon', 'end_lat', 'end_lon'])
+    upsert(Tag, [{'_id': tag} for tag in set().union(*links.values())])
+    db.session.execute(sa.delete(act_tag_assoc_table)
+                       .where(act_tag_assoc_table.c.activity_id.in_(ids)))
+    tag_rows = [{'activity_id': _id, 'tag_id': tag}
+                for _id, tags in links.items() for tag in tags]
+    if tag_rows:
+        db.session.execute(sa.insert(act_tag_assoc_table), tag_rows)
+
+    # analysis happens later, in "flask analyze-worker"
+    upsert(AnalysisJob, [{'activity_id': _id, 'state': 'queued',
+                          'attempts': 0, 'error': None, 'queued_date': now}
+                         for _id in ids],
+           keys=['activity_id'],
+           update=['state', 'attempts', 'error', 'queued_date'])
+
+    # the statements went around the session, so anything it has
+    # loaded of these is out of date
+    stale = set(ids)
+    for obj in list(db.session.identity_map.values()):
+        state = sa.inspect(obj)
+        if ((isinstance(obj, Activity) and state.identity[0] in stale) or
+                (isinstance(obj, AnalysisJob) and
+                 state.dict.get('activity_id') in stale)):
+            db.session.expire(obj)
+    stats.add(deltas)
+    return ids
 
 
 gRoutes = None
+gRouteIndex = None
 
 
 def analyze_activity(activity):
-    import polyline
-    import numpy as np
-    global gRoutes
+    global gRoutes, gRouteIndex
     if not gRoutes:
         gRoutes = analysis.read_routes_numpy()
+    if not gRouteIndex:
+        gRouteIndex = analysis.route_segment_index(gRoutes)
 
     if isinstance(activity, int):
-        activity = Activity.query.get(activity)
+        activity = (Activity.query
+                    .options(undefer_group('polylines'))
+                    .get(activity))
 
     pl = activity.map_polyline
     if not pl:
@@ -257,35 +396,96 @@ def analyze_activity(activity):
     if not pl:
         return
 
-    pts = np.array(polyline.decode(activity.map_polyline))[:, (1, 0)]
-
     current_app.logger.info(f'Analysing {activity}')
-    d2r, rtnums, deltas = analysis.activity_first_pass(pts, gRoutes)
-    segs, on_route = analysis.activity_segment(pts, rtnums, d2r, deltas)
-    on_route = int(on_route)
-
-    results = {
-        'coordinates': pts,
-        'route_nums': rtnums,
-        'dist_to_rtes': d2r,
-        'deltas': deltas,
-        'segments': segs
-        }
+    results, on_route = analysis.analyze_polyline(pl, gRoutes, gRouteIndex)
 
     current_app.logger.info(f'{activity}: {on_route/1000.} of '
                             f'{activity.distance/1000.} (km) on route.')
 
-    activity.on_course = int(on_route)
+    deltas = stats.analysis_deltas(
+        activity.start_date, on_route, stats.route_distances(results),
+        old_on_course=activity.on_course,
+        old_routes=(stats.route_distances(activity.analysis)
+                    if activity.analysis_state == 'done' else None))
+    activity.on_course = on_route
     activity.analysis = results
+    activity.analysis_state = 'done'
+    forget_artifacts([activity._id])
     db.session.flush()
+    stats.add(deltas)
+
+
+def analyze_all(all=True, processes=None, chunk_size=100):
+    # analyze the whole archive (or just the new ones) on a process
+    # pool, writing the results back a chunk at a time
+    q = db.session.query(Activity._id, Activity.map_polyline,
+                         Activity.map_summary_polyline, Activity.start_date,
+                         Activity.on_course)
+    if not all:
+        q = q.filter(Activity.analysis_state == None)  # noqa E711
+    items, old = [], {}
+    for _id, mpl, spl, start_date, on_course in q:
+        if mpl or spl:
+            items.append((_id, mpl or spl))
+            old[_id] = (start_date, on_course)
+
+    done = failed = 0
+    rows = []
+
+    def write():
+        ids = [row['_id'] for row in rows]
+        db.session.execute(sa.update(Activity), rows)
+        forget_artifacts(ids)
+        # nothing left for the analysis worker to do for these
+        (AnalysisJob.query
+         .filter(AnalysisJob.activity_id.in_(ids))
+         .update({'state': 'done', 'error': None,
+                  'finished_date': datetime.utcnow()},
+                 synchronize_session=False))
+        if not all:
+            # new ones, there are no old analyses to take off.
+            # the pool sends the results encoded
+            from app.analysis_codec import decode
+            for row in rows:
+                start_date, on_course = old[row['_id']]
+                stats.add(stats.analysis_deltas(
+                    start_date, row['on_course'],
+                    stats.route_distances(decode(row['analysis'])),
+                    old_on_course=on_course))
+        db.session.commit()
+        rows.clear()
+
+    for _id, results, on_route in analysis.analyze_polylines_parallel(
+            items, processes=processes):
+        if results is None:
+            current_app.logger.info(f'Analysis failed for {_id}: {on_route}')
+            failed += 1
+            continue
+        rows.append({'_id': _id, 'analysis': results, 'on_course': on_route,
+                     'analysis_state': 'done'})
+        done += 1
+        if len(rows) >= chunk_size:
+            write()
+    if rows:
+        write()
+    if all:
+        # the old analyses weren't loaded to take them off the
+        # route totals, so count them all again
+        stats.rebuild()
+
+    return dict(done=done, failed=failed)
 
 
 def analyze_activities(all=False, page=None, before=None, after=None,
                        per_page=100):
+    # queue activities for the analysis worker, doing them here
+    # takes too long for a web request
     try:
-        activities = db.session.query(Activity)
+        activities = (db.session.query(Activity)
+                      .options(load_only(Activity._id)))
         if not all:  # only get new activities
-            activities = activities.filter(Activity.analysis == None)  # noqa E711
+            activities = activities.filter(
+                Activity.analysis_state == None)  # noqa E711
         if page:
             activities = activities.paginate(
                 page=int(page), per_page=int(per_page)).items
@@ -295,16 +495,78 @@ def analyze_activities(all=False, page=None, before=None, after=None,
 
     i = 0
     for activity in activities:
-        analyze_activity(activity)
+        enqueue_analysis(activity)
         i += 1
 
     db.session.commit()
-    return f'Analyzed {i} activities.'
+    return f'Queued {i} activities for analysis.'
+
+
+def enqueue_analysis(activity):
+    # add (or re-add) the activity to the analysis queue
+    job = AnalysisJob.query.filter_by(activity_id=activity._id).one_or_none()
+    if job is None:
+        job = AnalysisJob(activity=activity, attempts=0)
+        db.session.add(job)
+    job.state = 'queued'
+    job.attempts = 0
+    job.error = None
+    job.queued_date = datetime.utcnow()
+    return job
+
+
+def analyze_queue(batch_size=10, max_batches=None, max_attempts=3):
+    # work through the analysis queue, committing after every batch
+    # so a crash only loses the batch it was working on
+    done = failed = batches = 0
+    while max_batches is None or batches < int(max_batches):
+        jobs = (AnalysisJob.query
+                .filter(AnalysisJob.state == 'queued',
+                        AnalysisJob.attempts < max_attempts)
+                .options(selectinload(AnalysisJob.activity)
+                         .undefer_group('polylines'))
+                .order_by(AnalysisJob._id)
+                .limit(int(batch_size))
+                .with_for_update(skip_locked=True)
+                .all())
+        if not jobs:
+            break
+
+        for job in jobs:
+            job.state = 'running'
+            job.attempts += 1
+            job.started_date = datetime.utcnow()
+            t0 = time.perf_counter()
+            try:
+                with db.session.begin_nested():
+                    analyze_activity(job.activity)
+            except Exception as e:
+                current_app.logger.exception(
+                    f'Analysis failed for {job.activity_id}')
+                job.error = repr(e)
+                job.state = ('queued' if job.attempts < max_attempts
+                             else 'failed')
+                failed += 1
+            else:
+                job.error = None
+                job.state = 'done'
+                done += 1
+            job.finished_date = datetime.utcnow()
+            job.elapsed = time.perf_counter() - t0
+
+        db.session.commit()
+        batches += 1
+
+    if done:
+        # so the new ones show up in the map tiles
+        refresh_artifacts()
+
+    return dict(done=done, failed=failed, batches=batches)
 
 
 def activity_to_geojson_features(activity, collect=True):
     import numpy as np
-    from app.nb_rdp import rdp
+    from app.nb_rdp import rdp_lonlat_to_m
 
     # global gRoutes
     # if not gRoutes:
@@ -313,7 +575,8 @@ def activity_to_geojson_features(activity, collect=True):
 
     if isinstance(activity, int):
         activity = (Activity.query
-                    .options(joinedload(Activity.athlete))
+                    .options(joinedload(Activity.athlete),
+                             undefer(Activity.analysis))
                     .get(activity))
 
     if not (activity and activity.analysis):
@@ -323,8 +586,8 @@ def activity_to_geojson_features(activity, collect=True):
     rts = set([int(s['route_num']) for s in segs if s['route_num'] > 0] + [0])
     pls = {rt: {'distance': 0, 'polystring': []} for rt in rts}
     for s in activity.analysis.get('segments'):
-        # Ramer-Douglas-Peucker reduction (epsilon=?) roughly 20m
-        pts = rdp(s['coordinates'], epsilon=20)
+        # Ramer-Douglas-Peucker reduction to 20m
+        pts = rdp_lonlat_to_m(s['coordinates'], epsilon=20)
         if pts.shape[0] < 2:    # ignore 1 point lines
             continue
 
@@ -369,6 +632,36 @@ def activity_to_geojson_features(activity, collect=True):
     return features
 
 
+def iter_geojson_features(activities):
+    for i, activity in enumerate(activities):
+        current_app.logger.info(f'Making GEOJSON LS for activity [{i}]: '
+                                f'{activity._id}: {activity.name}')
+        yield from activity_to_geojson_features(activity, collect=False)
+
+
+def write_geojson_features(features, filepath):
+    # stream a FeatureCollection to filepath, a feature (or an already
+    # serialized string of them) at a time.
+    # written to a temp file first so readers never see half of it
+    import os
+    tmp = filepath + '.tmp'
+    with open(tmp, 'w') as fp:
+        fp.write('{"type": "FeatureCollection", "features": [\n')
+        n = 0
+        for feature in features:
+            if not feature:
+                continue
+            if n:
+                fp.write(',\n')
+            if isinstance(feature, str):
+                fp.write(feature)
+            else:
+                geojson.dump(feature, fp)
+            n += 1
+        fp.write('\n]}\n')
+    os.replace(tmp, filepath)
+
+
 def activities_to_geojson(activities=None, filename=None):
     from filelock import Timeout, FileLock
 
@@ -384,26 +677,35 @@ def activities_to_geojson(activities=None, filename=None):
 
     try:
 
+        if not activities and filename:
+            # only the new or changed activities need work
+            refresh_artifacts()
+            features = (db.session.query(ActivityArtifact.features)
+                        .join(Activity)
+                        .order_by(ActivityArtifact.activity_id)
+                        .yield_per(100))
+            write_geojson_features((f for f, in features), filepath)
+            write_variants(filepath)
+            update_manifest(export_name(filename), filepath)
+            return 'Done.'
+
         if not activities:
             activities = db.session.query(Activity)
-            activities = activities.options(lazyload(Activity.athlete))
-
-        feature_list = []
-        for i, activity in enumerate(activities):
-            current_app.logger.info(f'Making GEOJSON LS for activity [{i}]: '
-                                    f'{activity._id}: {activity.name}')
-            features = activity_to_geojson_features(activity, collect=False)
-            feature_list.extend(features)
-
-        fcollection = geojson.FeatureCollection(feature_list)
+            activities = (activities
+                          .options(lazyload(Activity.athlete),
+                                   undefer(Activity.analysis))
+                          .yield_per(100))
 
         if filename:
-            from os.path import dirname, relpath, join
-            filepath = join(dirname(relpath(__file__)), filename)
-            with open(filepath, 'w') as fp:
-                geojson.dump(fcollection, fp)
+            write_geojson_features(iter_geojson_features(activities),
+                                   filepath)
+            write_variants(filepath)
+            update_manifest(export_name(filename), filepath)
             return 'Done.'
 
+        fcollection = geojson.FeatureCollection(
+            list(iter_geojson_features(activities)))
+
     finally:
         if filename:
             lock.release()
@@ -411,10 +713,60 @@ def activities_to_geojson(activities=None, filename=None):
     return fcollection
 
 
+def forget_artifacts(activity_ids):
+    # their analysis changed, make them again next time
+    (db.session.query(ActivityArtifact)
+     .filter(ActivityArtifact.activity_id.in_(activity_ids))
+     .delete(synchronize_session=False))
+
+
+def refresh_artifacts(chunk_size=50):
+    # (re)make the map features and heat points of the activities
+    # that are new or changed since they were last made
+    import numpy as np
+    stale = (db.session.query(Activity, ActivityArtifact)
+             .outerjoin(ActivityArtifact)
+             .filter(Activity.analysis_state == 'done')
+             .filter(sa.or_(ActivityArtifact.activity_id == None,  # noqa E711
+                            ActivityArtifact.version != ARTIFACT_VERSION,
+                            ActivityArtifact.last_updated !=
+                            Activity.last_updated))
+             .options(undefer(Activity.analysis),
+                      joinedload(Activity.athlete))
+             .order_by(Activity._id)
+             .limit(chunk_size))
+
+    i = 0
+    while True:
+        # the made ones aren't stale anymore, so keep taking the first
+        batch = stale.all()
+        if not batch:
+            break
+        for activity, art in batch:
+            current_app.logger.info(f'Making map artifacts for activity '
+                                    f'[{i}]: {activity._id}: {activity.name}')
+            if art is None:
+                art = ActivityArtifact(activity_id=activity._id)
+                db.session.add(art)
+            features = activity_to_geojson_features(activity, collect=False)
+            art.features = ',\n'.join(geojson.dumps(ft) for ft in features)
+            heat_pts = activity_to_heatmap_points(activity, jsonify=False)
+            art.heat_points = (None if heat_pts is None else
+                               np.ascontiguousarray(heat_pts,
+                                                    dtype=np.float64).tobytes())
+            art.version = ARTIFACT_VERSION
+            art.last_updated = activity.last_updated
+            art.made_date = datetime.utcnow()
+            i += 1
+        db.session.commit()
+    return i
+
+
 def activity_to_heatmap_points(activity, jsonify=True):
 
     if isinstance(activity, int):
         activity = (Activity.query
+                    .options(undefer(Activity.analysis))
                     .get(activity))
 
     if not (activity and activity.analysis):
@@ -448,28 +800,51 @@ def activities_to_heatmap(activities=None, filename=None):
 
     try:
 
-        if not activities:
-            activities = db.session.query(Activity)
-
         heatmap_pts_arrays = []
+        if not activities:
+            # only the new or changed activities need work
+            refresh_artifacts()
+            activities = []
+            heat = (db.session.query(ActivityArtifact.heat_points)
+                    .join(Activity)
+                    .filter(ActivityArtifact.heat_points != None)  # noqa E711
+                    .order_by(ActivityArtifact.activity_id))
+            heatmap_pts_arrays = [np.frombuffer(h).reshape(-1, 3)
+                                  for h, in heat]
+
+        # resample them all at once
+        tracks = []
         for i, activity in enumerate(activities):
             current_app.logger.info(f'Making HEATMAP PTS for activity [{i}]: '
                                     f'{activity._id}: {activity.name}')
-            heatmap_pts = activity_to_heatmap_points(activity, jsonify=False)
-            if heatmap_pts is not None:
-                # print(heatmap_pts.shape)
-                heatmap_pts_arrays.append(heatmap_pts)
+            aa = activity.analysis
+            if aa:
+                tracks.append((aa['coordinates'], aa['dist_to_rtes'],
+                               aa['deltas']))
+        if tracks:
+            heatmap_pts_arrays.append(
+                analysis.values_to_heatmap_points(*map(list, zip(*tracks))))
 
         heatmap_pts = np.concatenate(heatmap_pts_arrays)
         # print(heatmap_pts.shape)
-        heatmap_json = [(round(pt[0], 4), round(pt[1], 4), round(pt[2], 1))
-                        for pt in heatmap_pts]
+        heatmap_json = np.column_stack([np.round(heatmap_pts[:, :2], 4),
+                                        np.round(heatmap_pts[:, 2], 1)])
+        heatmap_json = heatmap_json.tolist()
 
         if filename:
-            from os.path import dirname, relpath, join
+            from os.path import dirname, relpath, join, splitext
             filepath = join(dirname(relpath(__file__)), filename)
-            with open(filepath, 'w') as fp:
-                json.dump(heatmap_json, fp)
+            write_atomic(filepath, json.dumps(heatmap_json).encode())
+            write_variants(filepath)
+            update_manifest(export_name(filename), filepath)
+
+            # and summed on a grid for each zoom, see heatmap_grid
+            grid = analysis.quantize_heatmap_grid(
+                analysis.heatmap_grid(heatmap_pts))
+            gridpath = splitext(filepath)[0] + '_grid.json'
+            write_atomic(gridpath, json.dumps(grid).encode())
+            write_variants(gridpath)
+            update_manifest(export_name(gridpath), gridpath)
             return 'Done.'
 
     finally:
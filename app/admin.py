@@ -1,4 +1,4 @@
-from flask import (Blueprint, jsonify, request, current_app, url_for,
+from flask import (Blueprint, jsonify, request, url_for,
                    render_template, redirect, abort)
 from flask_login import current_user
 from flask_table import Table, Col, DatetimeCol
@@ -8,14 +8,18 @@ from wtforms import IntegerField
 from wtforms.widgets import SubmitInput
 
 import sqlalchemy as sa
-from sqlalchemy.sql import func, distinct
 from sqlalchemy.orm import joinedload
 
 # from app.auth import auth.oauth
 # import app.auth as auth
 import app.utils as utils
 import app.activities as activities
-from app.models import db, admin_required, Athlete, StravaEvent, Activity
+import app.strava as strava
+import app.strava_client as strava_client
+import app.ratelimit as ratelimit
+import app.stats as club_stats
+import app.analysis as analysis
+from app.models import db, admin_required, Athlete, Activity
 
 admin = Blueprint('admin', __name__)
 
@@ -51,6 +55,20 @@ def check_events():
     return jsonify(erange)
 
 
+@admin.route('/event_metrics')
+@admin_required
+def event_metrics():
+    return jsonify(strava.event_metrics())
+
+
+@admin.route('/strava_metrics')
+@admin_required
+def strava_metrics():
+    # api latency histograms (for this process only) and the budget
+    return jsonify(latency=strava_client.metrics(),
+                   rate_limit=ratelimit.status())
+
+
 @admin.route('/check_athletes')
 @admin_required
 def check_athletes():
@@ -171,32 +189,48 @@ def index():
         filter(Athlete.auth_granted).count()
     stats['incomplete'] = db.session.query(Athlete.auth_granted).\
         filter(Athlete.auth_granted == 0).count()
-    stats['wocblm_updates'] = db.session.query(StravaEvent.updates).\
-        filter(StravaEvent.updates.match('#WOCBLM')).count()
-    stats['saved activities'] = db.session.query(Activity._id).count()
-
-    q = db.session.query(func.sum(Activity.moving_time)
-                         .label("total_moving_time"),
-                         func.sum(Activity.on_course)
-                         .label("on_course_distance"),
-                         func.sum(Activity.distance)
-                         .label("total_distance"),
-                         func.count(distinct(Activity.athlete_id))
-                         .label("distinct athletes")
-                         )
-    result = q.first()
-
-    current_app.logger.info(f'{result}')
-    stats['athletes contributing'] = result[3]
-    stats['moving time (hours)'] = "{:.1f}".format(int(result[0])/3600)
-    stats['on course distance (km)'] = "{:.0f}".format(int(result[1])/1000)
+
+    # the rest is kept up to date in the club_stats table
+    totals = club_stats.totals()
+    stats['wocblm_updates'] = totals.wocblm_updates
+    stats['saved activities'] = totals.activities
+    stats['athletes contributing'] = totals.athletes
+    stats['moving time (hours)'] = "{:.1f}".format(totals.moving_time/3600)
+    stats['on course distance (km)'] = "{:.0f}".format(totals.on_course/1000)
     stats['on course distance (miles)'] = \
-        "{:.0f}".format(int(result[1])/1609.34)
-    stats['total distance (km)'] = "{:.0f}".format(int(result[2])/1000)
-    stats['total distance (miles)'] = "{:.0f}".format(int(result[2])/1609.34)
+        "{:.0f}".format(totals.on_course/1609.34)
+    stats['total distance (km)'] = "{:.0f}".format(totals.distance/1000)
+    stats['total distance (miles)'] = \
+        "{:.0f}".format(totals.distance/1609.34)
+
+    names = analysis.route_names()
+    for rt, on_course in sorted(club_stats.routes().items()):
+        name = names[rt - 1] if rt <= len(names) else f'route {rt}'
+        stats[f'{name} on course (km)'] = "{:.0f}".format(on_course/1000)
 
     incomplete = Athlete.query.filter(Athlete.auth_granted == 0)
     incomplete_table = AthleteTable(incomplete)
 
     return render_template('admin.html', stats=stats,
                            incomplete_table=incomplete_table)
+
+
+@admin.route('/daily_stats')
+@admin_required
+def daily_stats():
+    keys = ['day', 'activities', 'distance', 'moving_time', 'on_course']
+    days = [dict(day=d._id[4:], activities=d.activities, distance=d.distance,
+                 moving_time=d.moving_time, on_course=d.on_course)
+            for d in club_stats.days()]
+
+    ext = request.args.get('ext')
+    if ext and ext.lower() in ['csv', 'txt']:
+        return utils.cvsfileify(days, keys, 'daily_stats')
+    else:
+        return jsonify(days)
+
+
+@admin.route('/rebuild_stats')
+@admin_required
+def rebuild_stats():
+    return jsonify(club_stats.rebuild())
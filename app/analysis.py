@@ -6,6 +6,8 @@ import geojson as gj
 import polyline as pl
 from scipy.spatial import ConvexHull
 
+import app.geodesy as geodesy
+
 
 nb.config.THREADING_LAYER = 'tbb'
 
@@ -32,7 +34,7 @@ def route_names():
     return _route_names
 
 
-def read_routes_numpy(dirpath='static/routes'):
+def read_routes_geojson(dirpath='static/routes'):
     # convert to pure python types for numba
     filepath = dirname(relpath(__file__))
     routes = [dict(gj.load(open(join(filepath,
@@ -45,7 +47,7 @@ def read_routes_numpy(dirpath='static/routes'):
         east = np.max([np.max(ls[:, 0]) for ls in mls])
         west = np.min([np.min(ls[:, 0]) for ls in mls])
         north = np.max([np.max(ls[:, 1]) for ls in mls])
-        south = np.min([np.min(ls[:, 0]) for ls in mls])
+        south = np.min([np.min(ls[:, 1]) for ls in mls])
         bbox = np.array([west, south, east, north])
         route['mls'] = mls
         route['bbox'] = bbox
@@ -54,6 +56,141 @@ def read_routes_numpy(dirpath='static/routes'):
     return routes
 
 
+# bump this if what goes in the route store changes
+ROUTE_STORE_VERSION = 1
+
+
+# routes_hash by dirpath: (mtime and size of the files, hash)
+_routes_hashes = {}
+
+
+def routes_hash(dirpath='static/routes'):
+    # hash of the route geojson, so a stale store is never used.
+    # kept for the process, it is only read and hashed again when
+    # the files change (the tiles ask for it on every request)
+    import os
+    import hashlib
+    filepath = dirname(relpath(__file__))
+    paths = [join(filepath, f'{dirpath}/{name}.geojson')
+             for name in route_names()]
+    stamp = [(st.st_mtime_ns, st.st_size) for st in map(os.stat, paths)]
+    cached = _routes_hashes.get(dirpath)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    h = hashlib.sha256(f'v{ROUTE_STORE_VERSION}'.encode())
+    for path in paths:
+        with open(path, 'rb') as fp:
+            h.update(fp.read())
+    _routes_hashes[dirpath] = (stamp, h.hexdigest())
+    return h.hexdigest()
+
+
+def build_route_store(dirpath='static/routes', storepath='route_store'):
+    # parse the geojson once and save the flattened geometry as .npy
+    # files that every worker can memory map (see load_route_store)
+    import os
+    import json
+    filepath = dirname(relpath(__file__))
+    storepath = join(filepath, storepath)
+    os.makedirs(storepath, exist_ok=True)
+
+    routes = read_routes_geojson(dirpath)
+    verts, ls_offsets, route_offsets = flatten_routes(routes)
+    # cumulative length (m) along each linestring
+    cumlen = deltas(verts)
+    cumlen[ls_offsets[:-1]] = 0
+    cumlen = np.cumsum(cumlen)
+    cumlen -= np.repeat(cumlen[ls_offsets[:-1]], np.diff(ls_offsets))
+
+    arrays = {
+        'vertices': verts,
+        'ls_offsets': ls_offsets,
+        'route_offsets': route_offsets,
+        'bbox': np.array([route['bbox'] for route in routes]),
+        'minbox': np.array([route['minbox'] for route in routes]),
+        'cumlen': cumlen,
+    }
+    for name, arr in arrays.items():
+        tmp = join(storepath, f'{name}.tmp.npy')
+        np.save(tmp, np.ascontiguousarray(arr))
+        os.replace(tmp, join(storepath, f'{name}.npy'))
+
+    # the manifest goes last, it is what says the store is good
+    manifest = {
+        'version': ROUTE_STORE_VERSION,
+        'hash': routes_hash(dirpath),
+        'routes': route_names(),
+    }
+    tmp = join(storepath, 'manifest.tmp.json')
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp, join(storepath, 'manifest.json'))
+    return arrays
+
+
+def load_route_store(dirpath='static/routes', storepath='route_store'):
+    # memory map the route store, (re)building it if it is missing
+    # or doesn't match the geojson.  returns None if it can't.
+    import json
+    from filelock import Timeout, FileLock
+    filepath = dirname(relpath(__file__))
+    fullpath = join(filepath, storepath)
+    names = ['vertices', 'ls_offsets', 'route_offsets',
+             'bbox', 'minbox', 'cumlen']
+
+    def load():
+        try:
+            with open(join(fullpath, 'manifest.json')) as fp:
+                manifest = json.load(fp)
+            if (manifest.get('version') != ROUTE_STORE_VERSION or
+                    manifest.get('hash') != routes_hash(dirpath)):
+                return None
+            return {name: np.load(join(fullpath, f'{name}.npy'),
+                                  mmap_mode='r')
+                    for name in names}
+        except (OSError, ValueError):
+            return None
+
+    store = load()
+    if store is None:
+        try:
+            with FileLock(fullpath + '.lock', timeout=60):
+                # someone else may have just built it
+                store = load()
+                if store is None:
+                    build_route_store(dirpath, storepath)
+                    store = load()
+        except (Timeout, OSError):
+            return None
+    return store
+
+
+def read_routes_numpy(dirpath='static/routes'):
+    # routes from the memory mapped store, the linestrings are
+    # views into the shared vertices.  same shape as the geojson
+    # version (which is the fallback.)
+    store = load_route_store(dirpath)
+    if store is None:
+        return read_routes_geojson(dirpath)
+
+    verts = store['vertices']
+    ls_offsets = store['ls_offsets']
+    route_offsets = store['route_offsets']
+    routes = []
+    for i, name in enumerate(route_names()):
+        lss = range(route_offsets[i], route_offsets[i+1])
+        routes.append({
+            'name': name,
+            'mls': [verts[ls_offsets[k]:ls_offsets[k+1]] for k in lss],
+            'bbox': store['bbox'][i],
+            'minbox': store['minbox'][i],
+            'length': sum(store['cumlen'][ls_offsets[k+1]-1] for k in lss),
+        })
+
+    return routes
+
+
 def obbox(mls):
     # find bounding box for multilinestring
     east = np.max([np.max(ls[:, 0]) for ls in mls])
@@ -82,7 +219,7 @@ def bbox(mls):
     return bbox, (east-west)*(north-south)
 
 
-@nb.jit
+@nb.jit(cache=True)
 def bbox_pts(hull):
     # area not adjusted.. in sqr degrees
     E = hull[:, 0].max()
@@ -98,7 +235,7 @@ def bbox_pts(hull):
     return bbox, area
 
 
-@nb.jit
+@nb.jit(cache=True)
 def rot_matrix(rm, theta):
     c, s = np.cos(theta), np.sin(theta)
     rm[0, 0] = c
@@ -107,7 +244,7 @@ def rot_matrix(rm, theta):
     rm[1, 1] = c
 
 
-@nb.jit
+@nb.jit(cache=True)
 def bbox_angle(hull, R):
     hullr = hull @ R
     bboxr, area = bbox_pts(hullr)
@@ -115,7 +252,7 @@ def bbox_angle(hull, R):
     return bbox, area
 
 
-@nb.jit()
+@nb.jit(cache=True)
 def find_rbbox_from_hull(hull):
     rm = np.array([[1.0, 0.0], [0.0, 1.0]])
     s = hull[0]-hull[-1]
@@ -197,7 +334,7 @@ def minimum_bounding_rectangle(points):
     return rval
 
 
-@nb.jit
+@nb.jit(cache=True)
 def triangle_area(A, B, C):
     return np.abs(
         A[0] * (B[1]-C[1]) +
@@ -206,7 +343,7 @@ def triangle_area(A, B, C):
     )/2
 
 
-@nb.njit
+@nb.njit(cache=True)
 def pt_in_rectangle(pt, rectangle, overscale=1.0001):
     A = triangle_area(pt, rectangle[0], rectangle[1])
     B = triangle_area(pt, rectangle[1], rectangle[2])
@@ -219,7 +356,7 @@ def pt_in_rectangle(pt, rectangle, overscale=1.0001):
     return AP <= AR * overscale
 
 
-@nb.njit(parallel=True)
+@nb.njit(parallel=True, cache=True)
 def pts_in_rectangle(pts, rect, overscale=1.0):
     inrect = pts[:, 0] == 0
     for i in nb.prange(pts.shape[0]):
@@ -227,7 +364,7 @@ def pts_in_rectangle(pts, rect, overscale=1.0):
     return inrect
 
 
-@nb.njit
+@nb.njit(cache=True)
 def dist2(pt1, pt2):
     # distance between two points squared
     mlat = (pt1[1] + pt2[1])/2
@@ -237,62 +374,186 @@ def dist2(pt1, pt2):
     return d2
 
 
-@nb.njit
+@nb.njit(cache=True)
 def dist_m(pt1, pt2):
     # distance in meters between two points
     return 111320 * np.sqrt(dist2(pt1, pt2))
 
 
-@nb.njit
-def deltas(pts):
-    delts = np.zeros(pts.shape[0])
-    for i in nb.prange(pts.shape[0]-1):
-        delts[i+1] = dist_m(pts[i], pts[i+1])
-    return delts
+def deltas(pts, coslat=None):
+    # distance (m) from the previous point
+    if coslat is None:
+        coslat = geodesy.cos_lat(pts)
+    return geodesy.deltas(pts, coslat)
 
 
-@nb.njit
+@nb.njit(cache=True)
 def dist_pt_to_segment(pt, v1, v2):
     # distance from point pt to line segment v1, v2
-    lls = (v1[0]-v2[0])**2 + (v1[1]-v2[1])**2
-    vm = (v1+v2)/2
-    chk = (pt[0]-vm[0])**2 + (pt[1]-vm[1])**2
-
-    if chk > 2*lls:
-        return dist_m(pt, vm)
-
-    # check this elsewhere.
-    # if (lls == 0):
-    #    return dist_m(pt, v1)
-    t = np.dot((pt - v1), (v2 - v1))/lls
-    if t <= 0:
-        pp = v1
-    elif t >= 1:
-        pp = v2
-    else:
-        pp = v1 + t * (v2 - v1)
-    # clip it from 0 to 1
-    return dist_m(pt, pp)
+    return geodesy.dist_to_segment(pt[0], pt[1], np.cos(pt[1]*np.pi/180),
+                                   v1[0], v1[1], v2[0], v2[1])
 
 
-@nb.njit(parallel=True)
+@nb.njit(cache=True)
 def dist_pt_to_linestring(pt, ls):
-    ds = np.zeros(ls.shape[0]-1)
-    for i in nb.prange(ls.shape[0]-1):
-        ds[i] = dist_pt_to_segment(pt, ls[i], ls[i+1])
-    return ds.min()
+    coslat = np.cos(pt[1]*np.pi/180)
+    dmin = np.inf
+    for i in range(ls.shape[0]-1):
+        d = geodesy.dist_to_segment(pt[0], pt[1], coslat,
+                                    ls[i, 0], ls[i, 1],
+                                    ls[i+1, 0], ls[i+1, 1])
+        if d < dmin:
+            dmin = d
+    return dmin
 
 
-# @nb.njit(parallel=True)
-# @nb.njit
 def dist_pt_to_multilinestring(pt, mls):
     ds = np.zeros(len(mls))
-#    for i in nb.prange(len(mls)):
     for i in range(len(mls)):
         ds[i] = dist_pt_to_linestring(pt, mls[i])
     return ds.min()
 
 
+def flatten_routes(routes):
+    # all the route vertices in one contiguous array, with the
+    # offsets of each linestring into the vertices and of each
+    # route into the linestrings.  (what the kernels want)
+    mls = [ls for route in routes for ls in route['mls']]
+    verts = np.ascontiguousarray(np.concatenate(mls), dtype=np.float64)
+    ls_offsets = np.zeros(len(mls) + 1, dtype=np.int64)
+    ls_offsets[1:] = np.cumsum([ls.shape[0] for ls in mls])
+    route_offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+    route_offsets[1:] = np.cumsum([len(route['mls']) for route in routes])
+    return verts, ls_offsets, route_offsets
+
+
+@nb.njit(parallel=True, cache=True)
+def dist_pts_to_routes(pts, coslat, ins, verts, ls_offsets, route_offsets):
+    # distance from each point to each route it is in the box of,
+    # checking every segment.  routes are from flatten_routes
+    d2 = np.full(ins.shape, np.inf)
+    for j in nb.prange(pts.shape[0]):
+        px, py, c = pts[j, 0], pts[j, 1], coslat[j]
+        for i in range(ins.shape[0]):
+            if not ins[i, j]:
+                continue
+            dmin = np.inf
+            for k in range(route_offsets[i], route_offsets[i+1]):
+                for v in range(ls_offsets[k], ls_offsets[k+1]-1):
+                    d = geodesy.dist_to_segment(
+                        px, py, c, verts[v, 0], verts[v, 1],
+                        verts[v+1, 0], verts[v+1, 1])
+                    if d < dmin:
+                        dmin = d
+            d2[i, j] = dmin
+    return d2
+
+
+def _segment_leaves(verts, segs, cell):
+    # bin segments (by start vertex) into the cells of a regular
+    # lon/lat grid, and give each non-empty cell the bounding box
+    # of the segments in it
+    v1 = verts[segs]
+    v2 = verts[segs + 1]
+    mid = (v1 + v2) / 2
+    ij = ((mid - mid.min(axis=0)) // cell).astype(np.int64)
+    cells = ij[:, 0] * (ij[:, 1].max() + 1) + ij[:, 1]
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    segs = segs[order]
+    first = np.flatnonzero(np.diff(cells, prepend=-1))
+    lo = np.minimum(v1, v2)[order]
+    hi = np.maximum(v1, v2)[order]
+    boxes = np.column_stack([np.minimum.reduceat(lo, first),
+                             np.maximum.reduceat(hi, first)])
+    return first, boxes, segs
+
+
+def route_segment_index(routes, cell_size=500.):
+    # spatial index over the segments of every route, for
+    # dist_pts_to_routes_indexed.  a one level, grid packed R-tree:
+    # the segments of each route are grouped by cells of roughly
+    # cell_size (meters), and each group keeps its bounding box so
+    # a point only has to look at the segments of nearby groups.
+    # build it once, it only depends on the routes.
+    verts, ls_offsets, route_offsets = flatten_routes(routes)
+    cell = cell_size / 111320
+    route_leaf = [0]
+    leaf_start = [np.zeros(0, dtype=np.int64)]
+    leaf_box = []
+    leaf_segs = []
+    nsegs = 0
+    for i in range(len(routes)):
+        segs = np.concatenate([
+            np.arange(ls_offsets[k], ls_offsets[k+1]-1)
+            for k in range(route_offsets[i], route_offsets[i+1])])
+        first, boxes, segs = _segment_leaves(verts, segs, cell)
+        leaf_start.append(first + nsegs)
+        leaf_box.append(boxes)
+        leaf_segs.append(segs)
+        route_leaf.append(route_leaf[-1] + first.shape[0])
+        nsegs += segs.shape[0]
+
+    return {
+        'vertices': verts,
+        'ls_offsets': ls_offsets,
+        'route_offsets': route_offsets,
+        'route_leaf': np.array(route_leaf, dtype=np.int64),
+        'leaf_box': np.concatenate(leaf_box),
+        'leaf_start': np.append(np.concatenate(leaf_start), nsegs),
+        'leaf_segs': np.concatenate(leaf_segs).astype(np.int64),
+    }
+
+
+@nb.njit(cache=True)
+def _dist_pt_to_leaf(px, py, coslat, dmin, leaf, verts,
+                     leaf_start, leaf_segs):
+    for k in range(leaf_start[leaf], leaf_start[leaf + 1]):
+        v = leaf_segs[k]
+        d = geodesy.dist_to_segment(px, py, coslat, verts[v, 0], verts[v, 1],
+                                    verts[v+1, 0], verts[v+1, 1])
+        if d < dmin:
+            dmin = d
+    return dmin
+
+
+@nb.njit(cache=True)
+def dist_pt_to_route_indexed(px, py, coslat, first, last, verts, leaf_box,
+                             leaf_start, leaf_segs):
+    # distance to the closest segment of the leaves first:last
+    # start with the closest leaf, then only look in the leaves
+    # that could have something closer than that.
+    lbs = np.empty(last - first)
+    best = first
+    for i in range(first, last):
+        lbs[i - first] = geodesy.dist_to_box(px, py, coslat, leaf_box[i])
+        if lbs[i - first] < lbs[best - first]:
+            best = i
+    dmin = _dist_pt_to_leaf(px, py, coslat, np.inf, best, verts,
+                            leaf_start, leaf_segs)
+    for i in range(first, last):
+        if lbs[i - first] < dmin and i != best:
+            dmin = _dist_pt_to_leaf(px, py, coslat, dmin, i, verts,
+                                    leaf_start, leaf_segs)
+    return dmin
+
+
+@nb.njit(parallel=True, cache=True)
+def dist_pts_to_routes_indexed(pts, coslat, ins, verts, route_leaf, leaf_box,
+                               leaf_start, leaf_segs):
+    # distance from each point to each route it is in the box of
+    # using the index from route_segment_index
+    d2 = np.full(ins.shape, np.inf)
+    for j in nb.prange(pts.shape[0]):
+        for i in range(ins.shape[0]):
+            if ins[i, j]:
+                d2[i, j] = dist_pt_to_route_indexed(
+                    pts[j, 0], pts[j, 1], coslat[j],
+                    route_leaf[i], route_leaf[i + 1],
+                    verts, leaf_box, leaf_start, leaf_segs)
+    return d2
+
+
 # find closest two routes
 # break activity into segments
 # a) point cloud
@@ -303,20 +564,26 @@ def dist_pt_to_multilinestring(pt, mls):
 # more strava like.. but no tools for this
 
 
-def activity_first_pass(pts, routes):
+def activity_first_pass(pts, routes, index=None):
     # find what every point
+    # index is from route_segment_index(routes), build it once and reuse
     nr = len(routes)
-    ins = np.ndarray((nr, pts.shape[0]), np.bool)
+    ins = np.ndarray((nr, pts.shape[0]), np.bool_)
     # roughly, are you in the box.
     for i in range(nr):
         ins[i] = pts_in_rectangle(pts, routes[i]['minbox'], overscale=1.3)
 
-    d2 = np.full((nr, pts.shape[0]), np.inf)
     # route distances
-    for j in range(pts.shape[0]):
-        for i in range(nr):
-            if ins[i, j]:
-                d2[i, j] = dist_pt_to_multilinestring(pts[j], routes[i]['mls'])
+    pts = np.ascontiguousarray(pts, dtype=np.float64)
+    coslat = geodesy.cos_lat(pts)
+    if index is None:
+        # every segment
+        d2 = dist_pts_to_routes(pts, coslat, ins, *flatten_routes(routes))
+    else:
+        # only nearby segments
+        d2 = dist_pts_to_routes_indexed(
+            pts, coslat, ins, index['vertices'], index['route_leaf'],
+            index['leaf_box'], index['leaf_start'], index['leaf_segs'])
 
     dist = np.amin(d2, axis=0)
     rtnum = np.argmin(d2, axis=0)+1
@@ -325,7 +592,7 @@ def activity_first_pass(pts, routes):
     if sel:
         rtnum[sel] = 0
 
-    delts = deltas(pts)
+    delts = deltas(pts, coslat)
 
     return dist, rtnum, delts
 
@@ -387,7 +654,9 @@ def activity_segment(pts, rtnumin, d2r, deltas):
             'coordinates': pts[i1:i2, :],
             'route_num': np.median(rtnum[i1:i2]),
             'distance': np.sum(deltas[i1+1:i2]),
-            'offroute': d2r[i1:i2]
+            'offroute': d2r[i1:i2],
+            'start': i1,
+            'stop': i2,
         }
         if segment['route_num'] > 0:
             on_route += segment['distance']
@@ -397,43 +666,172 @@ def activity_segment(pts, rtnumin, d2r, deltas):
     return segs, on_route
 
 
+def resample_track(pts, d2r, deltas, step=200., gap=2000.):
+    # lon, lat and d2r every step meters along the track, not across
+    # gaps over gap meters, or pieces with less than 3 points.
+    # pts, d2r and deltas can be lists of them (for many activities)
+    # it's all one np.interp over the whole distance along.
+    if isinstance(pts, (list, tuple)):
+        starts = np.cumsum([0] + [len(p) for p in pts[:-1]])
+        pts = np.concatenate(pts)
+        d2r = np.concatenate(d2r)
+        deltas = np.concatenate(deltas)
+        deltas[starts] = np.inf    # each activity is a new piece
+    if len(pts) == 0:
+        return np.empty((0, 2)), np.empty(0)
+
+    brk = deltas > gap
+    brk[0] = True
+    # a small step between the pieces keeps the distance increasing
+    x = np.cumsum(np.where(brk, 1., deltas))
+
+    starts = np.flatnonzero(brk)
+    ends = np.append(starts[1:], len(x))
+    keep = ends - starts >= 3
+    x0 = x[starts[keep]]
+    x1 = x[ends[keep] - 1]
+    # same points as np.arange(x0, x1, step) for every piece
+    cnt = np.maximum(np.ceil((x1 - x0) / step), 0).astype(np.int64)
+    first = np.cumsum(cnt) - cnt
+    xnew = (np.repeat(x0, cnt) +
+            step * (np.arange(cnt.sum()) - np.repeat(first, cnt)))
+
+    lonlat = np.column_stack([np.interp(xnew, x, pts[:, 0]),
+                              np.interp(xnew, x, pts[:, 1])])
+    return lonlat, np.interp(xnew, x, d2r)
+
+
 def values_to_heatmap_points(pts, d2r, deltas):
     # take the test points and make delta points
     # this will be used for simpleheat
-    import scipy.interpolate
-
-    delta_breaks = list((deltas > 2000).nonzero()[0])
-    x = np.cumsum(deltas)
-
-    xs = np.split(x, delta_breaks)
-    lons = np.split(pts[:, 0], delta_breaks)
-    lats = np.split(pts[:, 1], delta_breaks)
-    d2rs = np.split(d2r, delta_breaks)
-
-    lonl = []
-    latl = []
-    d2nl = []
-    for x, lon, lat, d2r in zip(xs, lons, lats, d2rs):
-        if x.shape[0] < 3:
-            continue
-        xnew = np.arange(x[0], x[-1], step=200)
-        lonl.append(scipy.interpolate.interp1d(x, lon)(xnew))
-        latl.append(scipy.interpolate.interp1d(x, lat)(xnew))
-        d2nl.append(scipy.interpolate.interp1d(x, d2r)(xnew))
-
-    lon = np.concatenate(lonl)
-    lat = np.concatenate(latl)
-    d2n = np.concatenate(d2nl)
+    lonlat, d2n = resample_track(pts, d2r, deltas)
 
     inten = np.ones(d2n.shape[0])
     inten[d2n > 200] = .8
     inten[d2n > 500] = .5
     inten[d2n > 1000] = .2
 
-    heat_pts = np.column_stack([lat, lon, inten])
+    heat_pts = np.column_stack([lonlat[:, 1], lonlat[:, 0], inten])
     return heat_pts
 
 
+HEATMAP_ZOOMS = (8, 10, 12, 14, 16)
+HEATMAP_CELL = 8    # pixels (of 256 pixel tiles) per grid cell
+
+
+def heatmap_grid(heat_pts, zooms=HEATMAP_ZOOMS, cell=HEATMAP_CELL):
+    # sum the (lat, lon, intensity) heat points into a web mercator
+    # grid for each zoom.  the size only depends on the area covered.
+    # returns {zoom: (x, y, intensity)}, x and y are the global cell
+    # numbers at that zoom, so the middle of the cell is at pixel
+    # (x + .5) * cell of the 2**zoom * 256 pixel world
+    lat = np.radians(heat_pts[:, 0])
+    mx = (heat_pts[:, 1] + 180) / 360
+    my = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+
+    grids = {}
+    for z in zooms:
+        n = 2**z * 256 // cell
+        ix = np.floor(mx * n).astype(np.int64)
+        iy = np.floor(my * n).astype(np.int64)
+        keys, inverse = np.unique(ix * n + iy, return_inverse=True)
+        grids[z] = (keys // n, keys % n,
+                    np.bincount(inverse, weights=heat_pts[:, 2]))
+    return grids
+
+
+def quantize_heatmap_grid(grids, cell=HEATMAP_CELL):
+    # json friendly: integer cells, intensity scaled to 1-255 per zoom
+    out = {'version': 1, 'cell': cell, 'zooms': {}}
+    for z, (x, y, inten) in grids.items():
+        top = float(inten.max()) if len(inten) else 1.
+        q = np.clip(np.ceil(inten / top * 255), 1, 255).astype(np.int64)
+        out['zooms'][str(z)] = {'max': round(top, 1), 'x': x.tolist(),
+                                'y': y.tolist(), 'v': q.tolist()}
+    return out
+
+
+def analyze_polyline(encoded, routes, index=None):
+    # analysis of one activity from its (google) polyline
+    # returns the results that get saved and the distance on route
+    pts = np.array(pl.decode(encoded))[:, (1, 0)]
+    d2r, rtnums, delts = activity_first_pass(pts, routes, index)
+    segs, on_route = activity_segment(pts, rtnums, d2r, delts)
+    results = {
+        'coordinates': pts,
+        'route_nums': rtnums,
+        'dist_to_rtes': d2r,
+        'deltas': delts,
+        'segments': segs
+        }
+    return results, int(on_route)
+
+
+# routes and index for each pool worker, loaded once per process
+_pool_routes = None
+
+
+def _pool_init():
+    global _pool_routes
+    # the parallelism is the processes, not the threads
+    nb.set_num_threads(1)
+    routes = read_routes_numpy()
+    _pool_routes = (routes, route_segment_index(routes))
+
+
+def _pool_analyze(item):
+    from app.analysis_codec import encode
+    _id, encoded = item
+    try:
+        results, on_route = analyze_polyline(encoded, *_pool_routes)
+    except Exception as e:
+        return _id, None, repr(e)
+    # send back the stored form, it is much smaller
+    return _id, encode(results), on_route
+
+
+def analyze_polylines_parallel(items, processes=None, chunksize=4):
+    # analyze (id, polyline) pairs on a process pool.
+    # yields (id, encoded results, on_route), or (id, None, error)
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+
+    # spawn, numba's thread pools don't survive a fork
+    with ProcessPoolExecutor(processes, mp_context=mp.get_context('spawn'),
+                             initializer=_pool_init) as ex:
+        yield from ex.map(_pool_analyze, items, chunksize=chunksize)
+
+
+def warmup():
+    # compile every numba kernel (or load it from the on disk cache)
+    # by running the analysis on the test activity, so the first real
+    # request doesn't have to.  returns seconds taken by each step.
+    import time
+    from app.nb_rdp import rdp_lonlat_to_m
+
+    timings = {}
+
+    def timed(name, func, *args, **kwargs):
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        timings[name] = time.perf_counter() - start
+        return ret
+
+    routes, pts, _ = timed('routes', generate_test_data)
+    timed('find_rbbox', find_rbbox, routes[0]['mls'])
+    index = timed('route_segment_index', route_segment_index, routes)
+    d2r, rtnum, delts = timed('activity_first_pass', activity_first_pass,
+                              pts, routes, index)
+    timed('activity_first_pass (no index)', activity_first_pass,
+          pts[:2], routes)
+    segs, _ = timed('activity_segment', activity_segment,
+                    pts, rtnum, d2r, delts)
+    timed('rdp', rdp_lonlat_to_m, segs[0]['coordinates'], epsilon=20)
+    timed('values_to_heatmap_points', values_to_heatmap_points,
+          pts, d2r, delts)
+    return timings
+
+
 def generate_test_data():
     routes = read_routes_numpy()
     tpl = (
@@ -0,0 +1,156 @@
+# analysis_codec.py
+# compact storage for the activity analysis results (Activity.analysis)
+#
+# layout, little endian:
+#   header   b'WOCA', version (u1), flags (u1), points (u4), segments (u4)
+#   table    (offset, nbytes) (u4, u4) for every column in COLUMNS
+#   columns  raw arrays, or each one zlib'd if flags has COMPRESSED
+#
+# segments are index ranges into the shared point columns, so reading
+# the segments doesn't need the route_nums or deltas, and nothing is
+# decoded (or decompressed) until it is asked for.
+import pickle
+import struct
+import zlib
+from collections.abc import Mapping
+
+import numpy as np
+
+
+MAGIC = b'WOCA'
+VERSION = 1
+COMPRESSED = 1
+
+# polylines are 1e-5 degrees, so this is lossless
+COORD_SCALE = 1e5
+
+COLUMNS = (
+    ('coordinates', '<i4'),
+    ('route_nums', '<i2'),
+    ('dist_to_rtes', '<f4'),
+    ('deltas', '<f4'),
+    ('seg_start', '<i4'),
+    ('seg_stop', '<i4'),
+    ('seg_route', '<f4'),
+    ('seg_distance', '<f4'),
+)
+
+KEYS = ('coordinates', 'route_nums', 'dist_to_rtes', 'deltas', 'segments')
+
+_header = struct.Struct('<4sBBII')
+_entry = struct.Struct('<II')
+
+
+def encode(results, compress=True):
+    # the analysis results dict (from analysis.analyze_polyline) to bytes
+    if isinstance(results, PackedAnalysis):
+        return results.blob
+
+    segs = results['segments']
+    cols = {
+        'coordinates': np.round(results['coordinates'] * COORD_SCALE),
+        'route_nums': results['route_nums'],
+        'dist_to_rtes': results['dist_to_rtes'],
+        'deltas': results['deltas'],
+        'seg_start': [s['start'] for s in segs],
+        'seg_stop': [s['stop'] for s in segs],
+        'seg_route': [s['route_num'] for s in segs],
+        'seg_distance': [s['distance'] for s in segs],
+    }
+
+    datas = []
+    for name, dtype in COLUMNS:
+        data = np.ascontiguousarray(cols[name], dtype=dtype).tobytes()
+        if compress:
+            data = zlib.compress(data)
+        datas.append(data)
+
+    npts = len(results['coordinates'])
+    flags = COMPRESSED if compress else 0
+    parts = [_header.pack(MAGIC, VERSION, flags, npts, len(segs))]
+    offset = _header.size + _entry.size * len(COLUMNS)
+    for data in datas:
+        parts.append(_entry.pack(offset, len(data)))
+        offset += len(data)
+    return b''.join(parts + datas)
+
+
+def decode(blob):
+    # bytes from the database, the old rows are pickled dicts
+    if blob[:len(MAGIC)] != MAGIC:
+        return pickle.loads(blob)
+    return PackedAnalysis(blob)
+
+
+class PackedAnalysis(Mapping):
+    "read only analysis results, decoded a column at a time"
+
+    def __init__(self, blob):
+        magic, version, flags, npts, nsegs = _header.unpack_from(blob)
+        if version > VERSION:
+            raise ValueError(f'Analysis version {version} is newer '
+                             f'than this code ({VERSION}).')
+        self.blob = blob
+        self.version = version
+        self.flags = flags
+        self.npts = npts
+        self.nsegs = nsegs
+        self._cache = {}
+
+    def _column(self, name):
+        if name in self._cache:
+            return self._cache[name]
+        i = [n for n, _ in COLUMNS].index(name)
+        offset, nbytes = _entry.unpack_from(self.blob,
+                                            _header.size + _entry.size * i)
+        data = self.blob[offset:offset + nbytes]
+        if self.flags & COMPRESSED:
+            data = zlib.decompress(data)
+        col = np.frombuffer(data, dtype=COLUMNS[i][1])
+        if name == 'coordinates':
+            col = col.reshape(-1, 2) / COORD_SCALE
+        self._cache[name] = col
+        return col
+
+    def segment_table(self):
+        # just the segment ranges, route numbers and distances
+        return {n: self._column('seg_' + n)
+                for n in ('start', 'stop', 'route', 'distance')}
+
+    @property
+    def on_route(self):
+        st = self.segment_table()
+        return float(np.sum(st['distance'][st['route'] > 0]))
+
+    def __getitem__(self, key):
+        if key == 'segments':
+            return self._segments()
+        if key not in KEYS:
+            raise KeyError(key)
+        return self._column(key)
+
+    def _segments(self):
+        pts = self._column('coordinates')
+        d2r = self._column('dist_to_rtes')
+        st = self.segment_table()
+        return [{
+            'coordinates': pts[i1:i2],
+            'route_num': rt,
+            'distance': dist,
+            'offroute': d2r[i1:i2],
+            'start': i1,
+            'stop': i2,
+        } for i1, i2, rt, dist in zip(st['start'].tolist(),
+                                      st['stop'].tolist(),
+                                      st['route'].tolist(),
+                                      st['distance'].tolist())]
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    def __repr__(self):
+        return (f'<PackedAnalysis v{self.version}: {self.npts} points, '
+                f'{self.nsegs} segments, {len(self.blob)} bytes>')
@@ -1,12 +1,16 @@
 # this only returns json data for use in javascript displays
 # from datetime import datetime
-from flask import Blueprint, jsonify
+from flask import (Blueprint, jsonify, abort, make_response, redirect,
+                   url_for, request, current_app)
 from flask_login import login_required, current_user
 
 # from app.models import db, admin_required, Athlete, Activity, get_or_create
 # from app.utils import hashtags
 # from app.auth import oauth
 import app.activities
+import app.utils as utils
+from app.models import Activity
+from sqlalchemy.orm import joinedload, undefer, undefer_group
 # import geojson
 
 
@@ -16,7 +20,9 @@ api = Blueprint('api', __name__)
 @api.route('/polylines')
 @login_required
 def polylines():
-    activities = current_user.activities
+    activities = (Activity.query
+                  .filter_by(athlete_id=current_user._id)
+                  .options(undefer_group('polylines')))
     activity_data = [{'id': activity._id,
                       'name': activity.name,
                       'polyline': activity.map_polyline
@@ -27,7 +33,68 @@ def polylines():
 @api.route('/geojson')
 @login_required
 def activitities_geojson():
-    activities = current_user.activities
+    activities = (Activity.query
+                  .filter_by(athlete_id=current_user._id)
+                  .options(joinedload(Activity.athlete),
+                           undefer(Activity.analysis)))
     gj = app.activities.activities_to_geojson(activities)
-    # return geojson.dumps(gj)
-    return jsonify(gj)
+    return utils.geojson_response(gj)
+
+
+# the exports the admin pages make, served in the smallest form
+# the client can take
+EXPORTS = {
+    'multilinestring_map': ('static/routes/multilinestring_map.geojson',
+                            'application/json'),
+    'heatmap': ('static/routes/heatmap.json', 'application/json'),
+    'heatmap_grid': ('static/routes/heatmap_grid.json', 'application/json'),
+    'activities_raw': ('static/routes/activities_raw.geojson',
+                       'application/json'),
+}
+
+
+def export_path(name):
+    from os.path import dirname, abspath, join
+    return join(dirname(abspath(__file__)), EXPORTS[name][0])
+
+
+@api.app_template_global()
+def export_url(name):
+    # the url that never changes for this version of the export
+    hash = utils.export_hash(name)
+    if hash:
+        return url_for('api.export', name=name, hash=hash)
+    return url_for('static', filename=EXPORTS[name][0][len('static/'):])
+
+
+@api.route('/export/<name>')
+@api.route('/export/<name>/<hash>')
+def export(name, hash=None):
+    from os.path import exists
+    if name not in EXPORTS:
+        abort(404)
+    filepath = export_path(name)
+    if not exists(filepath):
+        abort(404)
+    current = utils.export_hash(name)
+    if hash and current and hash != current:
+        # an old version, send them to the new one
+        return redirect(url_for('api.export', name=name, hash=current))
+    return utils.send_variant(filepath, EXPORTS[name][1], etag=current,
+                              immutable=bool(hash and hash == current))
+
+
+@api.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.pbf')
+def tile(layer, z, x, y):
+    import app.tiles as tiles
+    data = tiles.get_tile(layer, z, x, y)
+    if data is None:
+        abort(404)
+    resp = make_response(data)
+    resp.mimetype = 'application/vnd.mapbox-vector-tile'
+    # the url stays the same when the data changes, so it is cached
+    # for a while and then it is a 304 if the tile is the same
+    resp.add_etag()
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config.get('TILE_MAX_AGE', 3600)
+    return resp.make_conditional(request)
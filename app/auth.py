@@ -33,12 +33,10 @@ def on_token_update(sender, name, token, refresh_token=None,
 
 def strava_update_token(token, refresh_token=None, access_token=None):
     with current_app.app_context():
-        if refresh_token:
-            ath = Athlete.query.filter_by(refresh_token=refresh_token).first()
-        elif access_token:
-            ath = Athlete.query.filter_by(access_token=access_token).first()
-        else:
+        if not (refresh_token or access_token):
             return
+        ath = Athlete.by_token(refresh_token=refresh_token,
+                               access_token=access_token)
 
         # current_app.logger.debug(f'update token: {token}')
         if ath is None:
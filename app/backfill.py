@@ -0,0 +1,151 @@
+# backfill.py
+# get the woc activities of all the athletes from strava, many at a time.
+# asyncio keeps up to `concurrency` requests going, each one on a thread
+# (strava_client is requests, so blocking) at backfill priority, so the
+# rate limiter paces them and leaves budget for the webhooks.
+# only the event loop (main) thread touches the database, the activities
+# are written and committed in batches as they arrive.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from authlib.integrations.base_client import OAuthError
+
+import app.strava_client as strava_client
+import app.ratelimit as ratelimit
+from app.activities import is_woc, store_activities
+from app.models import db, Athlete, Activity
+
+PER_PAGE = 200
+
+# refresh tokens that expire before this (seconds), so nothing needs
+# refreshing while the requests are out on the threads
+TOKEN_MARGIN = 3600
+
+
+class Backfill(object):
+
+    def __init__(self, app, concurrency=8, batch_size=50, before=None,
+                 after=None, max_wait=None):
+        self.app = app
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.params = {k: v for k, v in (('before', before),
+                                         ('after', after)) if v}
+        # by default wait out a full 15 minute window
+        self.max_wait = 900 if max_wait is None else max_wait
+        self.known = set()
+        self.pending = []
+        self.saved = 0
+        self.failed = 0
+        self.limited = 0
+
+    def _get(self, url, token, params):
+        # on a pool thread
+        with self.app.app_context(), \
+                ratelimit.priority(ratelimit.BACKFILL, self.max_wait):
+            resp = strava_client.request('GET', url, token=token,
+                                         params=params)
+            resp.raise_for_status()
+            return resp.json()
+
+    async def get(self, url, token, params=None):
+        async with self.sem:
+            return await self.loop.run_in_executor(
+                self.pool, self._get, url, token, params)
+
+    async def athlete(self, athlete_id, token):
+        # the athlete's activity list, a page at a time, then the
+        # details of the woc ones we don't have
+        ids, details = [], []
+        try:
+            page = 1
+            while True:
+                summaries = await self.get(
+                    'athlete/activities', token,
+                    dict(self.params, page=page, per_page=PER_PAGE))
+                for summary in summaries:
+                    if summary['id'] not in self.known and is_woc(summary):
+                        self.known.add(summary['id'])
+                        ids.append(summary['id'])
+                        details.append(self.activity(summary['id'],
+                                                     athlete_id, token))
+                if len(summaries) < PER_PAGE:
+                    break
+                page += 1
+        except Exception as e:
+            self.failure(f'athlete {athlete_id}', e)
+            return
+        for _id, e in zip(ids, await asyncio.gather(
+                *details, return_exceptions=True)):
+            if e is not None:
+                self.failure(f'activity {_id}', e)
+
+    def failure(self, what, e):
+        if isinstance(e, ratelimit.RateLimited):
+            self.limited += 1
+        else:
+            self.failed += 1
+        current_app.logger.info(f'Backfill of {what} failed: {e!r}')
+
+    async def activity(self, activity_id, athlete_id, token):
+        data = await self.get(f'activities/{activity_id}', token)
+        self.pending.append((data, athlete_id))
+        if len(self.pending) >= self.batch_size:
+            self.write()
+
+    def write(self):
+        # one transaction per batch
+        batch, self.pending = self.pending, []
+        store_activities(batch)
+        db.session.commit()
+        self.saved += len(batch)
+        current_app.logger.info(f'Backfill: saved {self.saved} activities')
+
+    def refresh_tokens(self, athletes):
+        # serially, here, so the new tokens are saved
+        tokens = {}
+        for athlete in athletes:
+            token = athlete.auth_token
+            if (token['expires_at'] or 0) < time.time() + TOKEN_MARGIN:
+                try:
+                    token = strava_client.refresh_token(token)
+                except OAuthError as e:
+                    current_app.logger.info(f'Backfill: no token for '
+                                            f'{athlete}: {e!r}')
+                    self.failed += 1
+                    continue
+                athlete.auth_token = token
+            tokens[athlete._id] = token
+        db.session.commit()
+        return tokens
+
+    async def run(self, athletes):
+        self.loop = asyncio.get_running_loop()
+        self.sem = asyncio.Semaphore(self.concurrency)
+        tokens = self.refresh_tokens(athletes)
+        self.known = set(_id for _id, in db.session.query(Activity._id))
+        with ThreadPoolExecutor(self.concurrency) as self.pool:
+            await asyncio.gather(*[self.athlete(_id, token)
+                                   for _id, token in tokens.items()])
+        if self.pending:
+            self.write()
+
+
+def backfill(athlete_ids=None, concurrency=8, batch_size=50, before=None,
+             after=None, max_wait=None):
+    # the authorized athletes (or just these ones)
+    athletes = Athlete.query.filter(Athlete.refresh_token != None)  # noqa E711
+    if athlete_ids:
+        athletes = athletes.filter(Athlete._id.in_(athlete_ids))
+    athletes = athletes.all()
+
+    t0 = time.perf_counter()
+    bf = Backfill(current_app._get_current_object(), concurrency=concurrency,
+                  batch_size=batch_size, before=before, after=after,
+                  max_wait=max_wait)
+    asyncio.run(bf.run(athletes))
+    return dict(athletes=len(athletes), saved=bf.saved, failed=bf.failed,
+                rate_limited=bf.limited,
+                seconds=round(time.perf_counter() - t0, 1))
@@ -0,0 +1,68 @@
+# geodesy.py
+# distances on lon/lat points (lon in index[0]), in meters.
+# small areas only: every point gets its own equirectangular
+# projection, so cos(lat) is computed once per point and the inner
+# loops are plain cartesian math.
+import numpy as np
+import numba as nb
+
+
+M_PER_DEG = 111320.
+
+
+def cos_lat(pts):
+    # the lon scale (to meters) at every point
+    return np.cos(np.asarray(pts)[:, 1]*np.pi/180)
+
+
+def to_local(pts, origin=None):
+    # project to meters east/north of origin (default is the middle
+    # of pts.)  good for simplifying or measuring one activity
+    pts = np.asarray(pts, dtype=np.float64)
+    if origin is None:
+        origin = (pts.min(axis=0) + pts.max(axis=0))/2
+    xy = (pts - origin) * M_PER_DEG
+    xy[:, 0] *= np.cos(origin[1]*np.pi/180)
+    return xy
+
+
+@nb.njit(cache=True)
+def deltas(pts, coslat):
+    # distance from the previous point, 0 for the first
+    delts = np.zeros(pts.shape[0])
+    for i in range(1, pts.shape[0]):
+        dx = (pts[i, 0] - pts[i-1, 0]) * (coslat[i] + coslat[i-1])/2
+        dy = pts[i, 1] - pts[i-1, 1]
+        delts[i] = M_PER_DEG * np.sqrt(dx**2 + dy**2)
+    return delts
+
+
+@nb.njit(cache=True)
+def cumulative_distance(pts, coslat):
+    # distance along the line to every point
+    return np.cumsum(deltas(pts, coslat))
+
+
+@nb.njit(cache=True)
+def dist_to_segment(px, py, coslat, x1, y1, x2, y2):
+    # distance from point (px, py) to the segment (x1, y1), (x2, y2)
+    # in the projection of the point, coslat is cos(py)
+    ax = (x1 - px) * coslat
+    ay = y1 - py
+    dx = (x2 - px) * coslat - ax
+    dy = y2 - py - ay
+    lls = dx**2 + dy**2
+    t = 0.
+    if lls > 0:
+        # clip it from 0 to 1
+        t = min(max(-(ax*dx + ay*dy)/lls, 0.), 1.)
+    return M_PER_DEG * np.sqrt((ax + t*dx)**2 + (ay + t*dy)**2)
+
+
+@nb.njit(cache=True)
+def dist_to_box(px, py, coslat, box):
+    # distance from the point to the box (west, south, east, north)
+    # 0 inside.  nothing in the box can be closer than this.
+    dx = max(box[0] - px, 0., px - box[2]) * coslat
+    dy = max(box[1] - py, 0., py - box[3])
+    return M_PER_DEG * np.sqrt(dx**2 + dy**2)
@@ -3,7 +3,7 @@ from flask import (Blueprint, render_template, jsonify, redirect,
 from flask_login import login_required, current_user
 
 # from app.models import db
-from app.auth import oauth
+import app.strava_client as strava_client
 # import app.strava as strava
 
 main = Blueprint('main', __name__)
@@ -53,7 +53,7 @@ def activate():
 def activity(activity_id):
     url = f"activities/{activity_id}"
     current_app.logger.info(f'Get: {url}')
-    resp = oauth.strava.request(
+    resp = strava_client.request(
         'GET', url, params={'include_all_efforts': ' '})
     current_app.logger.info(resp)
     return jsonify(resp.json())
@@ -62,7 +62,7 @@ def activity(activity_id):
 @main.route('/map_activity/<activity_id>')
 def map_activity(activity_id):
     url = f"activities/{activity_id}"
-    resp = oauth.strava.request(
+    resp = strava_client.request(
         'GET', url, params={'include_all_efforts': ' '})
     current_app.logger.info(f'GET: {url} = {resp.status_code}')
     data = resp.json()
@@ -55,6 +55,9 @@ class Athlete(db.Model, UserMixin):
     access_token = db.Column(db.String(8192), nullable=True)
     access_token_expires_at = db.Column(db.Integer)
     refresh_token = db.Column(db.String(8192), nullable=True)
+    # the tokens are looked up by these, instead of indexing 8K strings
+    access_token_hash = db.Column(db.String(64), index=True)
+    refresh_token_hash = db.Column(db.String(64), index=True)
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
     last_updated = db.Column(db.DateTime, onupdate=datetime.utcnow)
     last_activity_check = db.Column(db.DateTime)
@@ -109,6 +112,23 @@ class Athlete(db.Model, UserMixin):
             else:
                 self.deauthorize()
 
+    @db.validates('access_token', 'refresh_token')
+    def _hash_token(self, key, token):
+        setattr(self, f'{key}_hash', token_hash(token))
+        return token
+
+    @classmethod
+    def by_token(cls, refresh_token=None, access_token=None):
+        # the athlete with this token (refresh token first)
+        if refresh_token:
+            key, token = 'refresh_token', refresh_token
+        elif access_token:
+            key, token = 'access_token', access_token
+        else:
+            return None
+        return cls.query.filter_by(**{f'{key}_hash': token_hash(token),
+                                      key: token}).first()
+
     def deauthorize(self):
         self.auth_granted = False
         self.access_token = None
@@ -121,6 +141,14 @@ class Athlete(db.Model, UserMixin):
         return f'{self.firstname} {self.lastname}'
 
 
+def token_hash(token):
+    # sha256 hex of a token, for looking it up
+    if not token:
+        return None
+    import hashlib
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 class Point(object):
     def __init__(self, lat, lon):
         self.lat = lat
@@ -142,11 +170,14 @@ class Point(object):
 
 
 # many to many needs association table
+# (the key keeps an activity from getting the same tag twice)
 act_tag_assoc_table = db.Table('act_tag_assoc', db.Model.metadata,
                                db.Column('tag_id', db.String(32),
-                                         db.ForeignKey('tag._id')),
+                                         db.ForeignKey('tag._id'),
+                                         primary_key=True),
                                db.Column('activity_id', db.BigInteger,
-                                         db.ForeignKey('activity._id'))
+                                         db.ForeignKey('activity._id'),
+                                         primary_key=True)
                                )
 
 
@@ -160,30 +191,32 @@ class Tag(db.Model):
         return f'#{self._id.upper()}'
 
 
-def compare_dicts_with_ndarrays(dict_a, dict_b):
-    import numpy as np
-    if isinstance(dict_a, dict) and isinstance(dict_b, dict):
-        if dict_a.keys() != dict_b.keys():
-            return False
-        for key in dict_a.keys():
-            try:
-                if dict_a[key] != dict_b[key]:
-                    return False
-            except ValueError:
-                # try:
-                if not np.array_equal(dict_a[key], dict_b[key]):
-                    return False
-                # except:
-                #     return False
-        return True
-    else:
-        return dict_a == dict_b
+class AnalysisType(db.TypeDecorator):
+    "analysis results, stored with app.analysis_codec"
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        from app.analysis_codec import encode
+        if value is None or isinstance(value, bytes):
+            return value
+        return encode(value)
+
+    def process_result_value(self, value, dialect):
+        from app.analysis_codec import decode
+        if value is None:
+            return None
+        return decode(value)
+
+    def compare_values(self, x, y):
+        # only a new results object is a change
+        return x is y
 
 
 class Activity(db.Model):
     _id = db.Column(db.BigInteger, primary_key=True)
     athlete_id = db.Column(db.BigInteger, db.ForeignKey('athlete._id'),
-                           nullable=False)
+                           nullable=False, index=True)
     athlete = db.relationship('Athlete',
                               backref=db.backref('activities', lazy=True))
     tags = db.relationship('Tag', secondary=act_tag_assoc_table,
@@ -193,8 +226,10 @@ class Activity(db.Model):
     # tags = db.Column(db.String)
     activity_type = db.Column(db.String(32))
     start_date = db.Column(db.DateTime)
-    map_polyline = db.Column(db.Text)
-    map_summary_polyline = db.Column(db.Text)
+    # the big columns are only loaded when asked for,
+    # use undefer / undefer_group in the query that needs them
+    map_polyline = db.deferred(db.Column(db.Text), group='polylines')
+    map_summary_polyline = db.deferred(db.Column(db.Text), group='polylines')
     distance = db.Column(db.Integer)
     moving_time = db.Column(db.Integer)
     elapsed_time = db.Column(db.Integer)
@@ -210,11 +245,46 @@ class Activity(db.Model):
     manual = db.Column(db.Boolean)
     private = db.Column(db.Boolean)
     flagged = db.Column(db.Boolean)
-    details = db.Column(db.JSON, nullable=True)
+    details = db.deferred(db.Column(db.JSON, nullable=True))
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
     on_course = db.Column(db.Integer)
-    analysis = db.Column(db.PickleType(
-        comparator=compare_dicts_with_ndarrays))
+    analysis = db.deferred(db.Column(AnalysisType))
+    # 'done' when there is an analysis, NULL until then (the
+    # AnalysisJob has the details), so finding them needs no blobs
+    analysis_state = db.Column(db.String(10), index=True)
+
+
+class AnalysisJob(db.Model):
+    "an activity waiting for (or done with) analysis"
+    _id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.BigInteger, db.ForeignKey('activity._id'),
+                            nullable=False, unique=True)
+    activity = db.relationship('Activity')
+    # queued, running, done or failed
+    state = db.Column(db.String(10), default='queued', index=True)
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    queued_date = db.Column(db.DateTime, default=datetime.utcnow)
+    started_date = db.Column(db.DateTime)
+    finished_date = db.Column(db.DateTime)
+    elapsed = db.Column(db.Float)  # seconds
+
+    def __repr__(self):
+        return f'<AnalysisJob {self._id}: {self.activity_id} {self.state}>'
+
+
+class ActivityArtifact(db.Model):
+    "the map features and heat points made from an activity's analysis"
+    activity_id = db.Column(db.BigInteger, db.ForeignKey('activity._id'),
+                            primary_key=True)
+    # what it was made from, it is stale if these don't match
+    version = db.Column(db.Integer)
+    last_updated = db.Column(db.DateTime)
+    made_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # comma separated geojson features, ready to paste in a collection
+    features = db.deferred(db.Column(db.Text))
+    # float64 (lat, lon, intensity) rows
+    heat_points = db.deferred(db.Column(db.LargeBinary))
 
 
 class Route(db.Model):
@@ -232,6 +302,11 @@ class Route(db.Model):
 
 
 class StravaEvent(db.Model):
+    __table_args__ = (
+        # the event worker groups the pending events by object
+        db.Index('ix_strava_event_pending', 'state', 'object_type',
+                 'object_id'),
+    )
     _id = db.Column(db.BigInteger, primary_key=True)
     object_id = db.Column(db.BigInteger)
     aspect_type = db.Column(db.String(10))
@@ -241,6 +316,23 @@ class StravaEvent(db.Model):
     event_time = db.Column(db.BigInteger)
     subscription_id = db.Column(db.BigInteger)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # webhook events are "pending" until the event worker has them,
+    # then "done" or "failed".  older events have no state.
+    state = db.Column(db.String(10), index=True)
+    processed_date = db.Column(db.DateTime)
+    result = db.Column(db.String(256))
+
+
+class ClubStats(db.Model):
+    "running totals for the admin dashboard, kept up by app/stats.py"
+    # 'total', 'route:<route number>' or 'day:<yyyy-mm-dd>'
+    _id = db.Column(db.String(32), primary_key=True)
+    activities = db.Column(db.BigInteger, default=0)
+    athletes = db.Column(db.BigInteger, default=0)
+    distance = db.Column(db.BigInteger, default=0)  # meters
+    moving_time = db.Column(db.BigInteger, default=0)  # seconds
+    on_course = db.Column(db.BigInteger, default=0)  # meters
+    wocblm_updates = db.Column(db.BigInteger, default=0)
 
 
 def get_or_create(model, defaults=None, **kwargs):
@@ -259,3 +351,56 @@ def get_or_create(model, defaults=None, **kwargs):
             return instance, True
         except IntegrityError:
             return db.session.query(model).filter_by(**kwargs).one(), False
+
+
+def upsert(model, rows, keys=None, update=(), keep=(), add=(), conn=None):
+    """
+    Insert rows (dicts) of a model or table in one statement.  rows that
+    are already there (by the keys, default is the primary key) get the
+    update columns set, or are left alone if there aren't any.  the keep
+    columns are only updated with values that aren't None, and the add
+    columns are added to what is there (add columns are updated too).
+    ON CONFLICT for sqlite and postgresql, ON DUPLICATE KEY for mysql.
+    runs on the session, or on conn if there is one.
+    """
+    from sqlalchemy import func
+
+    if not rows:
+        return
+    table = getattr(model, '__table__', model)
+    keys = keys or [c.name for c in table.primary_key]
+    update = list(update) + [col for col in add if col not in update]
+    conn = db.session if conn is None else conn
+    bind = conn.get_bind() if hasattr(conn, 'get_bind') else conn
+    dialect = bind.dialect.name
+
+    def value(new, col):
+        if col in add:
+            return table.c[col] + new[col]
+        if col in keep:
+            return func.coalesce(new[col], table.c[col])
+        return new[col]
+
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        if update:
+            stmt = stmt.on_duplicate_key_update(
+                {col: value(stmt.inserted, col) for col in update})
+        else:
+            stmt = stmt.prefix_with('IGNORE')
+    elif dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        if update:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_={col: value(stmt.excluded, col) for col in update})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+    else:
+        raise NotImplementedError(f'No upsert for {dialect}')
+    conn.execute(stmt, rows)
@@ -65,7 +65,7 @@ def pldist(point, start, end):
         np.linalg.norm(end - start))
 
 
-@njit
+@njit(cache=True)
 def dist_ll_m(pt1, pt2):
     # distance in meters between two points
     # distance between two coordinates
@@ -78,7 +78,7 @@ def dist_ll_m(pt1, pt2):
     return 111320 * sqrt(d2)
 
 
-@njit
+@njit(cache=True)
 def dist_cart(pt1, pt2):
     # just distance in cartesian coordinates
     d = pt1 - pt2
@@ -111,10 +111,33 @@ def dist_to_segment(pt, v1, v2, dist=dist_cart):
     return dist(pt, pp)
 
 
-@njit
+@njit(cache=True)
+def _dist_to_segment(pt, v1, v2, lonlat):
+    # dist_to_segment with the distance picked by a flag instead of
+    # passed in.  numba can't cache anything that gets a function as
+    # an argument (its type is different in every process)
+    lls = (v1[0]-v2[0])**2 + (v1[1]-v2[1])**2
+    vm = (v1+v2)/2
+    chk = (pt[0]-vm[0])**2 + (pt[1]-vm[1])**2
+
+    if chk <= 4*lls:
+        t = np.dot((pt - v1), (v2 - v1))/lls
+        if t <= 0:
+            vm = v1
+        elif t >= 1:
+            vm = v2
+        else:
+            vm = v1 + t * (v2 - v1)
+
+    if lonlat:
+        return dist_ll_m(pt, vm)
+    return dist_cart(pt, vm)
+
+
+@njit(cache=True)
 def dist_to_segment_lonlat_to_m(pt, v1, v2):
     # numba doesnt' do partial yet
-    return dist_to_segment(pt, v1, v2, dist=dist_ll_m)
+    return _dist_to_segment(pt, v1, v2, True)
 
 
 def rdp_rec(M, epsilon, dist=pldist):
@@ -180,6 +203,38 @@ def _rdp_iter(M, start_index, last_index, epsilon, dist=pldist):
     return indices > 0
 
 
+@njit(cache=True)
+def _rdp_iter_segment(M, start_index, last_index, epsilon, lonlat):
+    # _rdp_iter for the dist_to_segment distances, which can be cached
+    stk = []
+    stk.append([start_index, last_index])
+    global_start_index = start_index
+    indices = np.ones(last_index - start_index + 1, dtype=np.byte)
+
+    while stk:
+        start_index, last_index = stk.pop()
+
+        dmax = 0.0
+        index = start_index
+
+        for i in range(index + 1, last_index):
+            if indices[i - global_start_index]:
+                d = _dist_to_segment(M[i], M[start_index], M[last_index],
+                                     lonlat)
+                if d > dmax:
+                    index = i
+                    dmax = d
+
+        if dmax > epsilon:
+            stk.append([start_index, index])
+            stk.append([index, last_index])
+        else:
+            for i in range(start_index + 1, last_index):
+                indices[i - global_start_index] = False
+
+    return indices > 0
+
+
 def rdp_iter(M, epsilon, dist=pldist, return_mask=False):
     """
     Simplifies a given array of points.
@@ -196,7 +251,12 @@ def rdp_iter(M, epsilon, dist=pldist, return_mask=False):
     :param return_mask: return the mask of points to keep instead
     :type return_mask: bool
     """
-    mask = _rdp_iter(M, 0, len(M) - 1, epsilon, dist)
+    if USE_NUMBA and dist is dist_to_segment:
+        mask = _rdp_iter_segment(M, 0, len(M) - 1, epsilon, False)
+    elif USE_NUMBA and dist is dist_to_segment_lonlat_to_m:
+        mask = _rdp_iter_segment(M, 0, len(M) - 1, epsilon, True)
+    else:
+        mask = _rdp_iter(M, 0, len(M) - 1, epsilon, dist)
 
     if return_mask:
         return mask
@@ -204,8 +264,23 @@ def rdp_iter(M, epsilon, dist=pldist, return_mask=False):
     return M[mask]
 
 
-def rdp_lonlat_to_m(M, dist=dist_to_segment_lonlat_to_m, **kwargs):
-    return rdp(M, dist=dist, **kwargs)
+def rdp_lonlat_to_m(M, epsilon=0, return_mask=False):
+    # epsilon in meters.  project the whole line to meters once and
+    # simplify that, instead of converting inside every distance
+    from app.geodesy import to_local
+
+    arr = np.asarray(M, dtype=np.float64)
+    if len(arr) < 3:
+        mask = np.ones(len(arr), dtype=bool)
+    else:
+        mask = rdp_iter(to_local(arr), epsilon,
+                        dist_to_segment if USE_NUMBA else pldist,
+                        return_mask=True)
+    if return_mask:
+        return mask
+    if "numpy" in str(type(M)):
+        return M[mask]
+    return arr[mask].tolist()
 
 
 def rdp(M, epsilon=0, dist=dist_to_segment if USE_NUMBA else pldist,
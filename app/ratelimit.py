@@ -0,0 +1,197 @@
+# ratelimit.py
+# the Strava API budget, shared by all the workers on this machine.
+# strava allows so many requests every 15 minutes (windows start on the
+# quarter hour) and every day (midnight UTC), and reports the limits and
+# what has been used in the X-RateLimit-Limit / X-RateLimit-Usage
+# headers.  the state is a little json file under a file lock.  every
+# request is counted there before it is sent, and the headers correct
+# the counts when the response comes back.
+#
+# webhook fetches (and anything interactive) can spend the whole budget.
+# backfills leave STRAVA_RATE_RESERVE of it for them, and are spread out
+# over what is left of the window instead of spending it all at once.
+# in a web request the interactive calls don't wait at all, they raise
+# RateLimited (a 429 with Retry-After, see strava.rate_limited) instead
+# of holding the worker.
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os.path import dirname, relpath, join
+
+from flask import current_app, has_request_context
+
+# priorities
+WEBHOOK = 0
+BACKFILL = 1
+
+STATE_PATH = 'strava_ratelimit.json'
+
+WINDOWS = ('short', 'daily')
+
+# priority and max wait for this thread, see priority()
+_local = threading.local()
+
+
+class RateLimited(Exception):
+    "no budget left for this request, retry_after is in seconds"
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f'Strava rate limit, retry in {retry_after:.0f}s')
+
+
+def _path():
+    return join(dirname(relpath(__file__)), STATE_PATH)
+
+
+def _resets(now):
+    # when the current short and daily windows end
+    return {'short': (now // 900 + 1) * 900,
+            'daily': (now // 86400 + 1) * 86400}
+
+
+def _load(now):
+    limits = current_app.config.get('STRAVA_RATE_LIMITS', (100, 1000))
+    try:
+        with open(_path()) as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        state = {}
+    resets = _resets(now)
+    for name, limit in zip(WINDOWS, limits):
+        w = state.setdefault(name, {'limit': limit, 'usage': 0})
+        if w.get('reset') != resets[name]:
+            # a new window
+            w['usage'] = 0
+            w['reset'] = resets[name]
+    state.setdefault('paced', 0)
+    return state
+
+
+def _save(state):
+    tmp = f'{_path()}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(state, fp)
+    os.replace(tmp, _path())
+
+
+@contextmanager
+def _locked(timeout=10):
+    from filelock import FileLock
+    with FileLock(_path() + '.lock', timeout=timeout):
+        yield
+
+
+def _wait_time(state, level, now):
+    # seconds until there is budget for one more request
+    reserve = current_app.config.get('STRAVA_RATE_RESERVE', 0.2)
+    wait = 0
+    for name in WINDOWS:
+        w = state[name]
+        allowed = w['limit'] * (1 - reserve if level == BACKFILL else 1)
+        if w['usage'] + 1 > allowed:
+            wait = max(wait, w['reset'] - now)
+    if wait or level != BACKFILL:
+        return wait
+
+    # pace the backfill over the rest of the window
+    w = state['short']
+    left = w['limit'] * (1 - reserve) - w['usage']
+    interval = (w['reset'] - now) / max(left, 1)
+    return max(0, state['paced'] + interval - now)
+
+
+def current():
+    # (priority, max wait) for this thread
+    return (getattr(_local, 'level', WEBHOOK),
+            getattr(_local, 'max_wait', None))
+
+
+@contextmanager
+def priority(level, max_wait=None):
+    # the strava calls in this block are at this priority, and wait at
+    # most max_wait seconds for budget (STRAVA_RATE_MAX_WAIT by default)
+    old = current()
+    _local.level, _local.max_wait = level, max_wait
+    try:
+        yield
+    finally:
+        _local.level, _local.max_wait = old
+
+
+def acquire():
+    # wait for (and spend) budget for one request, raises RateLimited
+    # if that would take longer than the max wait
+    from filelock import Timeout
+    level, max_wait = current()
+    if max_wait is None:
+        if level == WEBHOOK and has_request_context():
+            # don't tie up a web worker, the caller can retry later
+            max_wait = 0
+        else:
+            max_wait = current_app.config.get('STRAVA_RATE_MAX_WAIT', 60)
+    deadline = time.time() + max_wait
+    while True:
+        now = time.time()
+        try:
+            with _locked(timeout=min(10, max(max_wait, 1))):
+                state = _load(now)
+                wait = _wait_time(state, level, now)
+                if wait <= 0:
+                    for name in WINDOWS:
+                        state[name]['usage'] += 1
+                    if level == BACKFILL:
+                        state['paced'] = now
+                    _save(state)
+                    return
+        except Timeout:
+            # the other workers have the state, try again in a bit
+            wait = 1
+        if now + wait > deadline:
+            raise RateLimited(wait)
+        time.sleep(wait)
+
+
+def update(resp):
+    # what strava says the limits and usage are
+    from filelock import Timeout
+    try:
+        limits = [int(n) for n in resp.headers['X-RateLimit-Limit'].split(',')]
+        usage = [int(n) for n in resp.headers['X-RateLimit-Usage'].split(',')]
+    except (KeyError, ValueError):
+        limits = usage = None
+    if not limits and resp.status_code != 429:
+        return
+
+    try:
+        with _locked(timeout=1 if has_request_context() else 10):
+            state = _load(time.time())
+            if limits:
+                for name, limit, used in zip(WINDOWS, limits, usage):
+                    w = state[name]
+                    w['limit'] = limit
+                    # our count also has the requests still on their way
+                    w['usage'] = max(w['usage'], used)
+            if resp.status_code == 429 and not limits:
+                # no headers, assume it is the short window
+                state['short']['usage'] = state['short']['limit']
+            _save(state)
+    except Timeout:
+        # the next response corrects the counts
+        current_app.logger.warning('Strava rate limit state is locked, '
+                                   'usage not updated')
+
+
+def status():
+    # the budget as this machine sees it
+    from filelock import Timeout
+    try:
+        with _locked(timeout=1):
+            state = _load(time.time())
+    except Timeout:
+        # it is only read, and replaced whole when it is written
+        state = _load(time.time())
+    return {name: {k: state[name][k] for k in ('limit', 'usage', 'reset')}
+            for name in WINDOWS}
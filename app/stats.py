@@ -0,0 +1,206 @@
+# stats.py
+# the club statistics for the admin dashboard, kept in the club_stats
+# table instead of counting and summing the activity and event tables on
+# every page load.  there is a 'total' row, one per route (on course
+# distance) and one per day (by activity start date).
+#
+# saving or analysing activities, and new webhook events, work out what
+# they change (deltas) and queue them on the session.  they are added to
+# the rows in one upsert just before the commit, in the same transaction,
+# so the workers don't hold locks on the totals while they talk to
+# strava, and anything rolled back is never counted.  "flask rebuild-stats" counts
+# everything again, if the totals ever drift.
+import sqlalchemy as sa
+from sqlalchemy.sql import func, distinct
+
+from app.models import db, upsert, Activity, StravaEvent, ClubStats
+
+TOTAL = 'total'
+
+COLUMNS = ('activities', 'athletes', 'distance', 'moving_time', 'on_course',
+           'wocblm_updates')
+
+# where the deltas wait for the commit
+SESSION_KEY = 'club_stats'
+
+
+def route_key(route_num):
+    return f'route:{route_num}'
+
+
+def day_key(start_date):
+    return f'day:{start_date:%Y-%m-%d}'
+
+
+def route_distances(results):
+    # on course distance of an analysis, by route number
+    if hasattr(results, 'segment_table'):
+        # packed, this way the points aren't decoded
+        st = results.segment_table()
+        segs = zip(st['route'].tolist(), st['distance'].tolist())
+    else:
+        segs = ((s['route_num'], s['distance'])
+                for s in (results or {}).get('segments', ()))
+    routes = {}
+    for rt, dist in segs:
+        if int(rt) > 0:
+            routes[int(rt)] = routes.get(int(rt), 0) + dist
+    return routes
+
+
+def _add(deltas, key, sign=1, **values):
+    d = deltas.setdefault(key, dict.fromkeys(COLUMNS, 0))
+    for col, value in values.items():
+        d[col] += sign * int(value or 0)
+
+
+def _activity(deltas, activity, sign=1):
+    # what an activity (a dict) adds to the total and its day
+    values = {col: activity.get(col)
+              for col in ('distance', 'moving_time', 'on_course')}
+    _add(deltas, TOTAL, sign, activities=1, **values)
+    if activity.get('start_date'):
+        _add(deltas, day_key(activity['start_date']), sign, activities=1,
+             **values)
+
+
+def stored_deltas(rows):
+    """
+    What storing these activity rows (id: dict) changes, worked out
+    before they are written.  the analysis of an activity that is there
+    already stays, so its on course distance moves with it.
+    """
+    deltas = {}
+    if not rows:
+        return deltas
+    old = {row._id: row._asdict() for row in db.session.query(
+        Activity._id, Activity.start_date, Activity.distance,
+        Activity.moving_time, Activity.on_course)
+        .filter(Activity._id.in_(list(rows)))}
+    for _id, row in rows.items():
+        was = old.get(_id)
+        if was:
+            _activity(deltas, was, -1)
+        _activity(deltas, dict(row, on_course=was and was['on_course']))
+
+    # athletes with their first activity
+    athletes = {row['athlete_id'] for row in rows.values()}
+    seen = {athlete_id for athlete_id, in db.session.query(
+        distinct(Activity.athlete_id))
+        .filter(Activity.athlete_id.in_(athletes))}
+    _add(deltas, TOTAL, athletes=len(athletes - seen))
+    return deltas
+
+
+def analysis_deltas(start_date, on_course, routes, old_on_course=None,
+                    old_routes=None):
+    # a new analysis, replacing the old one (if there was one)
+    deltas = {}
+    on_course = int(on_course or 0) - int(old_on_course or 0)
+    _add(deltas, TOTAL, on_course=on_course)
+    if start_date:
+        _add(deltas, day_key(start_date), on_course=on_course)
+    for rt, dist in routes.items():
+        _add(deltas, route_key(rt), on_course=dist)
+    for rt, dist in (old_routes or {}).items():
+        _add(deltas, route_key(rt), -1, on_course=dist)
+    return deltas
+
+
+def event_deltas(ev):
+    # the dashboard counts the updates that mention #wocblm
+    deltas = {}
+    if 'wocblm' in (ev.updates or '').lower():
+        _add(deltas, TOTAL, wocblm_updates=1)
+    return deltas
+
+
+def add(deltas, session=None):
+    # queue the deltas for when the session commits
+    session = session or db.session
+    pending = session.info.setdefault(SESSION_KEY, {})
+    for key, d in deltas.items():
+        _add(pending, key, **d)
+
+
+@sa.event.listens_for(db.session, 'before_commit')
+def _before_commit(session):
+    if session.in_nested_transaction():
+        # a savepoint, they wait for the real commit
+        return
+    deltas = session.info.pop(SESSION_KEY, None)
+    rows = [dict(_id=key, **d) for key, d in sorted((deltas or {}).items())
+            if any(d.values())]
+    # sorted, so concurrent updates lock the rows in the same order
+    upsert(ClubStats, rows, add=COLUMNS, conn=session.connection())
+
+
+@sa.event.listens_for(db.session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(SESSION_KEY, None)
+
+
+def rebuild(chunk_size=200):
+    # count everything again, and commit.  best done while the
+    # workers are quiet, what they commit meanwhile can be missed
+    db.session.info.pop(SESSION_KEY, None)
+    rows = {}
+
+    def row(key):
+        return rows.setdefault(key, dict(dict.fromkeys(COLUMNS, 0), _id=key))
+
+    sums = (func.count(Activity._id), func.sum(Activity.distance),
+            func.sum(Activity.moving_time), func.sum(Activity.on_course))
+
+    def set_sums(r, n, dist, moving, on_course):
+        r.update(activities=n, distance=int(dist or 0),
+                 moving_time=int(moving or 0), on_course=int(on_course or 0))
+
+    n, dist, moving, on_course, athletes = db.session.query(
+        *sums, func.count(distinct(Activity.athlete_id))).one()
+    set_sums(row(TOTAL), n, dist, moving, on_course)
+    row(TOTAL)['athletes'] = athletes
+    row(TOTAL)['wocblm_updates'] = (
+        db.session.query(func.count(StravaEvent._id))
+        .filter(StravaEvent.updates.ilike('%wocblm%')).scalar())
+
+    day = func.date(Activity.start_date)
+    for d, *values in (db.session.query(day, *sums)
+                       .filter(Activity.start_date != None)  # noqa E711
+                       .group_by(day)):
+        # a string on sqlite, a date elsewhere
+        set_sums(row(f'day:{str(d)[:10]}'), *values)
+
+    for results, in (db.session.query(Activity.analysis)
+                     .filter(Activity.analysis_state == 'done')
+                     .yield_per(chunk_size)):
+        for rt, dist in route_distances(results).items():
+            row(route_key(rt))['on_course'] += int(dist)
+
+    db.session.query(ClubStats).delete(synchronize_session=False)
+    db.session.execute(sa.insert(ClubStats), list(rows.values()))
+    db.session.commit()
+    return dict(days=sum(k.startswith('day:') for k in rows),
+                routes=sum(k.startswith('route:') for k in rows),
+                **{k: v for k, v in rows[TOTAL].items() if k != '_id'})
+
+
+def totals():
+    # the dashboard's one row (counted from scratch the first time)
+    stats = db.session.get(ClubStats, TOTAL)
+    if stats is None:
+        rebuild()
+        stats = db.session.get(ClubStats, TOTAL)
+    return stats
+
+
+def routes():
+    # on course distance by route number
+    return {int(r._id.split(':')[1]): r.on_course for r in
+            ClubStats.query.filter(ClubStats._id.like('route:%'))}
+
+
+def days():
+    return (ClubStats.query.filter(ClubStats._id.like('day:%'))
+            .order_by(ClubStats._id).all())
@@ -1,11 +1,14 @@
+from datetime import datetime
 from flask import (Blueprint, jsonify, request, current_app, url_for,
                    redirect, flash)
 from flask_login import login_required
 
 # from app.auth import auth.oauth
-import app.auth as auth
+import app.strava_client as strava_client
+import app.ratelimit as ratelimit
 import app.utils as utils
 import app.activities as activities
+import app.stats as stats
 from app.models import db, admin_required, Athlete, StravaEvent  # , Activity
 
 strava = Blueprint('strava', __name__)
@@ -14,7 +17,7 @@ STRAVA_SUBSCRIBE_URL = 'https://www.strava.com/api/v3/push_subscriptions'
 
 
 def deauthorize_athlete_from_token(token):
-    resp = auth.oauth.strava.request(
+    resp = strava_client.request(
         'POST', 'https://www.strava.com/oauth/deauthorize', token=token)
     return resp
 
@@ -39,7 +42,7 @@ def deauthorize(athlete_id):
 def avatar(path):
     # just pass it on to strava
     url = f'https://strava.com/avatar/{path}'
-    resp = auth.oauth.strava.request('GET', url, params=request.args)
+    resp = strava_client.request('GET', url, params=request.args)
     return resp.content
 
 
@@ -47,7 +50,7 @@ def get_club_info(api=None, params=None, token=None):
     club = current_app.config['STRAVA_CLUB_ID']
     url = f"clubs/{club}/{api}" if api else f"clubs/{club}"
     current_app.logger.info(f'Getting: {url}')
-    resp = auth.oauth.strava.request('GET', url, params=params, token=token)
+    resp = strava_client.request('GET', url, params=params, token=token)
     current_app.logger.info(resp)
     return resp.json()
 
@@ -110,7 +113,7 @@ def check_current_subscription():
         'client_id': current_app.config['STRAVA_CLIENT_ID'],
         'client_secret': current_app.config['STRAVA_CLIENT_SECRET'],
     }
-    resp = auth.oauth.strava.request(
+    resp = strava_client.request(
         'GET', STRAVA_SUBSCRIBE_URL, withhold_token=True, params=params)
 
     if resp.ok and resp.json():
@@ -125,7 +128,7 @@ def delete_subscription(sub_id):
         'client_id': current_app.config['STRAVA_CLIENT_ID'],
         'client_secret': current_app.config['STRAVA_CLIENT_SECRET'],
     }
-    resp = auth.oauth.strava.request(
+    resp = strava_client.request(
         'DELETE', STRAVA_SUBSCRIBE_URL+f'/{sub_id}',
         withhold_token=True, params=params)
     current_app.logger.info(f'Subscription delete: {resp}')
@@ -142,50 +145,209 @@ def subscribe(callback_url):
         'verify_token': current_app.config['STRAVA_VERIFY_TOKEN']
         }
 
-    resp = auth.oauth.strava.request('POST', subscribe_url,
-                                     withhold_token=True, params=params)
+    resp = strava_client.request('POST', subscribe_url,
+                                 withhold_token=True, params=params)
     current_app.logger.info(f'Strava notification subscription; {resp}')
 
 
 def handle_strava_webhook_event(data):
     """
-    This lets strava send us data.  Here's what this needs to do.
+    This lets strava send us data.  Strava wants an answer within
+    2 seconds, so all this does is log it.
 
     1.  Log it.
         a.  make a new entry & fill it out
-        b. save it to the database
+        b. save it to the database (as "pending")
         c. log it to the logger.
 
-    2.  If its an athlete.. problably need to delete the token
-
-    3.  If its an activity..
-        check if is an activity we care about
-        if so, check if we have it
-        if we dont, or its an update, download it again
-        save the activity
+    The event worker ("flask event-worker") does the rest,
+    see process_webhook_event.
     """
     current_app.logger.debug(f'StravaEvent {data}')
     # convert to string.. FIX DATABASE HERE
     updates = data.get('updates')
     data['updates'] = str(updates)
     ev = StravaEvent(**data)
+    ev.state = 'pending'
     db.session.add(ev)
     db.session.flush()
+    stats.add(stats.event_deltas(ev))
+    return ev
+
+
+def process_webhook_event(ev):
+    """
+    What to do with an event from the webhook.
+
+    1.  If its an athlete.. problably need to delete the token
 
+    2.  If its an activity..
+        check if is an activity we care about
+        if so, check if we have it
+        if we dont, or its an update, download it again
+        save the activity
+    """
     # ignore certain events
-    if 'update' not in data.get('aspect_type'):
-        return
+    if 'update' not in ev.aspect_type:
+        return 'Ignored.'
 
-    if data['object_type'] == 'activity':
-        activities.process_event(ev, commit=False)
+    if ev.object_type == 'activity':
+        return activities.process_event(ev, commit=False)
 
-    elif data['object_type'] == 'athlete':
-        oid = data.get('object_id')
+    elif ev.object_type == 'athlete':
+        oid = ev.object_id
         if oid:
             oid = int(oid)
-            current_app.logger.info(f"Athlete {oid}: {data['updates']}")
+            current_app.logger.info(f"Athlete {oid}: {ev.updates}")
             athlete = Athlete.query.get(oid)
-            athlete.deauthorize()
+            if athlete:
+                athlete.deauthorize()
+        return 'Deauthorized.'
+
+
+def coalesce_events(events):
+    """
+    One event standing in for a burst of events about the same object
+    (oldest first).  strava sends an update for every edit, title, then
+    description, then privacy..  so the updates are merged (newest wins)
+    and it is an update if any of them were.  it is not saved.
+    """
+    import ast
+
+    if len(events) == 1:
+        return events[0]
+    updates = {}
+    for ev in events:
+        try:
+            updates.update(ast.literal_eval(ev.updates or '{}'))
+        except (ValueError, SyntaxError, TypeError):
+            # not a dict, keep it for the hashtags anyway
+            updates[f'raw{ev._id}'] = ev.updates
+    newest = events[-1]
+    aspects = set(ev.aspect_type for ev in events)
+    return StravaEvent(
+        _id=newest._id,
+        object_type=newest.object_type,
+        object_id=newest.object_id,
+        owner_id=newest.owner_id,
+        aspect_type='update' if 'update' in aspects else newest.aspect_type,
+        updates=str(updates),
+        event_time=newest.event_time,
+        subscription_id=newest.subscription_id,
+        timestamp=newest.timestamp)
+
+
+def process_pending_events(batch_size=20, max_batches=None, window=None):
+    """
+    Work through the events the webhook saved, oldest first, committing
+    after every batch.
+
+    events are held until nothing new has come in for their object for
+    `window` seconds (EVENT_COALESCE_WINDOW), then all of them are
+    handled as one, so a burst of edits is one strava fetch.  batch_size
+    is in objects.  out of strava budget, the events are left pending.
+    """
+    from datetime import timedelta
+    from sqlalchemy import func, tuple_
+
+    if window is None:
+        window = current_app.config.get('EVENT_COALESCE_WINDOW', 10)
+    done = failed = coalesced = batches = 0
+    retry_after = None
+    while max_batches is None or batches < int(max_batches):
+        settled = datetime.utcnow() - timedelta(seconds=window)
+        keys = (db.session.query(StravaEvent.object_type,
+                                 StravaEvent.object_id)
+                .filter(StravaEvent.state == 'pending')
+                .group_by(StravaEvent.object_type, StravaEvent.object_id)
+                .having(func.max(StravaEvent.timestamp) <= settled)
+                .order_by(func.min(StravaEvent._id))
+                .limit(int(batch_size))
+                .all())
+        if not keys:
+            break
+        events = (StravaEvent.query
+                  .filter(StravaEvent.state == 'pending',
+                          tuple_(StravaEvent.object_type,
+                                 StravaEvent.object_id).in_(keys))
+                  .order_by(StravaEvent._id)
+                  .with_for_update(skip_locked=True)
+                  .all())
+        if not events:
+            break
+
+        bursts = {}
+        for ev in events:
+            bursts.setdefault((ev.object_type, ev.object_id), []).append(ev)
+
+        for burst in bursts.values():
+            lead = burst[-1]
+            try:
+                with db.session.begin_nested():
+                    result = process_webhook_event(coalesce_events(burst))
+            except ratelimit.RateLimited as e:
+                current_app.logger.info(f'Event {lead._id}: {e}')
+                retry_after = e.retry_after
+                break
+            except Exception as e:
+                current_app.logger.exception(f'Event {lead._id} failed')
+                state, result = 'failed', repr(e)
+                failed += 1
+            else:
+                state, result = 'done', str(result)
+                done += 1
+            for ev in burst:
+                ev.state = state
+                ev.result = (result if ev is lead
+                             else f'Coalesced into {lead._id}')[:256]
+                ev.processed_date = datetime.utcnow()
+            coalesced += len(burst) - 1
+
+        db.session.commit()
+        batches += 1
+        if retry_after is not None:
+            break
+
+    return dict(done=done, failed=failed, coalesced=coalesced,
+                batches=batches, retry_after=retry_after)
+
+
+def event_metrics(last=100):
+    # how far behind the event worker is, and how long it took
+    # from the event (on strava) to being done with it (seconds)
+    import numpy as np
+    from sqlalchemy.sql import func
+    from app.models import AnalysisJob
+
+    depth, oldest = (db.session.query(func.count(StravaEvent._id),
+                                      func.min(StravaEvent.timestamp))
+                     .filter(StravaEvent.state == 'pending').one())
+    recent = (db.session.query(StravaEvent.event_time,
+                               StravaEvent.processed_date)
+              .filter(StravaEvent.state.in_(['done', 'failed']))
+              .order_by(StravaEvent.processed_date.desc())
+              .limit(last).all())
+    latency = np.array([(done - datetime.utcfromtimestamp(t)).total_seconds()
+                        for t, done in recent if t and done])
+
+    metrics = {
+        'pending_events': depth,
+        'oldest_pending_age': ((datetime.utcnow() - oldest).total_seconds()
+                               if oldest else None),
+        'queued_analyses': (AnalysisJob.query
+                            .filter(AnalysisJob.state == 'queued').count()),
+    }
+    for p in (50, 95):
+        metrics[f'event_latency_p{p}'] = (float(np.percentile(latency, p))
+                                          if len(latency) else None)
+    return metrics
+
+
+@strava.app_errorhandler(ratelimit.RateLimited)
+def rate_limited(e):
+    retry = int(e.retry_after) + 1
+    return (jsonify({'error': 'Strava rate limit', 'retry_after': retry}),
+            429, {'Retry-After': str(retry)})
 
 
 # handle strava webhooks subscriptions
@@ -210,6 +372,7 @@ def webhook():
     data = request.get_json()
     handle_strava_webhook_event(data)
     db.session.commit()
+    # the event worker takes it from here
     return '', 200
 
 
@@ -0,0 +1,232 @@
+# strava_client.py
+# all the calls to the Strava API go through here.
+# authlib makes (and closes) a new session for every request, so every
+# call paid for a TLS handshake.  this keeps one keep-alive session per
+# thread, puts a timeout on everything, retries 5xx/429 with jittered
+# backoff, keeps latency histograms per endpoint, and waits for budget
+# from the rate limiter (ratelimit.py) before calling the api.
+import random
+import re
+import threading
+import time
+from urllib.parse import urljoin, urlparse
+
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+import app.ratelimit as ratelimit
+
+# latency buckets, in seconds.  the last one catches everything
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float('inf'))
+
+# methods that are safe to send again after a 5xx or a dropped connection.
+# a 429 was never processed, so that is retried for everything
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# the session for this thread
+_local = threading.local()
+
+# per endpoint stats for this process
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _config(key, default):
+    return current_app.config.get(key, default)
+
+
+def _remote():
+    import app.auth as auth
+    return auth.oauth.strava
+
+
+def _on_update_token(token, refresh_token=None, access_token=None):
+    # after the session refreshed an expired token: what authlib's own
+    # client does, the new token for this request and saved on the athlete
+    import app.auth as auth
+    _remote().token = token
+    auth.strava_update_token(token, refresh_token=refresh_token,
+                             access_token=access_token)
+
+
+def get_session():
+    # the keep-alive session for this thread.  an OAuth2 session made
+    # from the client config, so expired tokens are still refreshed
+    # (and saved by _on_update_token)
+    session = getattr(_local, 'session', None)
+    if session is None:
+        from authlib.integrations.requests_client import OAuth2Session
+        remote = _remote()
+        kwargs = remote.client_kwargs
+        session = OAuth2Session(
+            client_id=remote.client_id, client_secret=remote.client_secret,
+            token_endpoint_auth_method=kwargs.get(
+                'token_endpoint_auth_method'),
+            scope=kwargs.get('scope'),
+            token_endpoint=remote.access_token_url,
+            update_token=_on_update_token)
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=_config('STRAVA_POOL_SIZE', 10))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _local.session = session
+    return session
+
+
+def close_session():
+    session = getattr(_local, 'session', None)
+    if session is not None:
+        session.close()
+        _local.session = None
+
+
+def refresh_token(token):
+    # a new access token now, instead of when a request finds it expired
+    session = get_session()
+    session.token = token
+    return dict(session.refresh_token(session.metadata['token_endpoint'],
+                                      refresh_token=token['refresh_token']))
+
+
+def endpoint(method, url):
+    # the url without the ids, so the stats group by api call
+    path = urlparse(url).path
+    path = re.sub(r'^/api/v3', '', path)
+    path = re.sub(r'/\d+(?=/|$)', '/:id', path)
+    if path.startswith('/avatar/'):
+        path = '/avatar'
+    return f'{method} {path}'
+
+
+def _backoff(attempt, resp=None):
+    # exponential backoff with full jitter, or what the server asked for
+    base = _config('STRAVA_RETRY_BACKOFF', 0.5)
+    cap = _config('STRAVA_RETRY_MAX_WAIT', 30.)
+    if resp is not None:
+        try:
+            return min(float(resp.headers['Retry-After']), cap)
+        except (KeyError, ValueError):
+            pass
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _retryable(method, resp=None, error=None):
+    if resp is not None:
+        if resp.status_code == 429:
+            return True
+        return resp.status_code >= 500 and method in IDEMPOTENT
+    # a connect timeout never reached strava, anything else might have
+    connect_failed = (isinstance(error, ConnectionError) and
+                      not isinstance(error, Timeout))
+    return method in IDEMPOTENT or connect_failed
+
+
+def _record(name, elapsed, status, attempts):
+    with _stats_lock:
+        st = _stats.get(name)
+        if st is None:
+            st = _stats[name] = {'count': 0, 'sum': 0., 'max': 0.,
+                                 'retries': 0, 'errors': 0, 'status': {},
+                                 'buckets': [0] * len(BUCKETS)}
+        st['count'] += 1
+        st['sum'] += elapsed
+        st['max'] = max(st['max'], elapsed)
+        st['retries'] += attempts - 1
+        st['status'][status] = st['status'].get(status, 0) + 1
+        if not isinstance(status, int) or status >= 400:
+            st['errors'] += 1
+        for i, le in enumerate(BUCKETS):
+            if elapsed <= le:
+                st['buckets'][i] += 1
+                break
+
+
+def request(method, url, token=None, withhold_token=False, **kwargs):
+    # same as auth.oauth.strava.request, but pooled, with a timeout,
+    # retries and stats
+    remote = _remote()
+    method = method.upper()
+    if remote.api_base_url and not url.startswith(('https://', 'http://')):
+        url = urljoin(remote.api_base_url, url)
+    if token is None and not withhold_token:
+        # the logged in user
+        token = remote.token
+        if token is None:
+            from authlib.integrations.base_client import MissingTokenError
+            raise MissingTokenError()
+
+    kwargs.setdefault('timeout', tuple(_config('STRAVA_TIMEOUT', (3.05, 10))))
+    retries = _config('STRAVA_RETRIES', 3)
+    session = get_session()
+    name = endpoint(method, url)
+    # only the api counts against the rate limits
+    limited = '/api/v3/' in url
+
+    t0 = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        resp = None
+        if limited:
+            try:
+                ratelimit.acquire()
+            except ratelimit.RateLimited:
+                _record(name, time.perf_counter() - t0, 'limited', attempt)
+                raise
+        try:
+            if withhold_token:
+                resp = session.request(method, url, withhold_token=True,
+                                       **kwargs)
+            else:
+                session.token = token
+                resp = session.request(method, url, **kwargs)
+        except (ConnectionError, Timeout) as e:
+            if attempt > retries or not _retryable(method, error=e):
+                _record(name, time.perf_counter() - t0, 'error', attempt)
+                raise
+            wait = _backoff(attempt)
+            current_app.logger.info(f'Strava {name}: {e!r}, '
+                                    f'retry in {wait:.1f}s')
+        except Exception:
+            # token errors and the like, not worth another try
+            _record(name, time.perf_counter() - t0, 'error', attempt)
+            raise
+        else:
+            if limited:
+                ratelimit.update(resp)
+            if attempt > retries or not _retryable(method, resp):
+                _record(name, time.perf_counter() - t0, resp.status_code,
+                        attempt)
+                return resp
+            wait = _backoff(attempt, resp)
+            current_app.logger.info(f'Strava {name}: {resp.status_code}, '
+                                    f'retry in {wait:.1f}s')
+            resp.close()
+        time.sleep(wait)
+
+
+def metrics():
+    # latency histograms (cumulative, like prometheus) by endpoint
+    with _stats_lock:
+        out = {}
+        for name, st in sorted(_stats.items()):
+            cum, buckets = 0, {}
+            for le, n in zip(BUCKETS, st['buckets']):
+                cum += n
+                buckets['+Inf' if le == float('inf') else str(le)] = cum
+            out[name] = {
+                'count': st['count'],
+                'mean': st['sum'] / st['count'],
+                'max': st['max'],
+                'retries': st['retries'],
+                'errors': st['errors'],
+                'status': {str(k): v for k, v in st['status'].items()},
+                'buckets': buckets,
+            }
+        return out
+
+
+def reset_metrics():
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,271 @@
+# tiles.py
+# Mapbox vector tiles (v2) of the routes and the analysed activities,
+# so the map only downloads what it is looking at.
+# the protobuf is written by hand, it is only a few message types.
+import json
+import os
+import shutil
+from os.path import dirname, relpath, join
+
+import numpy as np
+
+EXTENT = 4096
+BUFFER = 64         # tile units of line kept past the edges
+MAX_ZOOM = 18
+CACHE_PATH = 'tile_cache'
+
+LAYERS = ('routes', 'activities')
+
+# loaded layer data for this process, by layer name
+_layers = {}
+
+
+# protobuf writing
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _field(num, wire):
+    return _varint((num << 3) | wire)
+
+
+def _message(num, data):
+    # length delimited field (strings, messages, packed)
+    return _field(num, 2) + _varint(len(data)) + data
+
+
+def _uint(num, n):
+    return _field(num, 0) + _varint(n)
+
+
+def _packed(num, ints):
+    return _message(num, b''.join(_varint(i) for i in ints))
+
+
+def _value(v):
+    if isinstance(v, bool):
+        return _uint(7, int(v))
+    if isinstance(v, (int, np.integer)):
+        return _uint(6, _zigzag(int(v)))
+    if isinstance(v, (float, np.floating)):
+        return _field(3, 1) + np.float64(v).tobytes()
+    return _message(1, str(v).encode())
+
+
+def _geometry(lines):
+    # MoveTo / LineTo commands with zigzag deltas, lines are int arrays
+    cmds = []
+    cx = cy = 0
+    for line in lines:
+        dxy = np.diff(line, axis=0, prepend=[[cx, cy]])
+        zz = ((dxy << 1) ^ (dxy >> 63)).tolist()
+        cmds += [(1 << 3) | 1, *zz[0], ((len(line) - 1) << 3) | 2]
+        for dx, dy in zz[1:]:
+            cmds += [dx, dy]
+        cx, cy = line[-1]
+    return cmds
+
+
+def encode_layer(name, features):
+    # features are (id, lines, properties)
+    keys, values = {}, {}
+    feats = []
+    for _id, lines, props in features:
+        tags = []
+        for k, v in props.items():
+            if v is None:
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault((type(v), v), len(values)))
+        feats.append(_message(2, _uint(1, _id) + _packed(2, tags) +
+                              _uint(3, 2) +  # LINESTRING
+                              _packed(4, _geometry(lines))))
+    return b''.join([
+        _uint(15, 2),
+        _message(1, name.encode()),
+        *feats,
+        *[_message(3, k.encode()) for k in keys],
+        *[_message(4, _value(v)) for _, v in values],
+        _uint(5, EXTENT),
+    ])
+
+
+def encode_tile(layers):
+    # layers is {name: features}, empty layers are left out
+    return b''.join(_message(3, encode_layer(name, features))
+                    for name, features in layers.items() if features)
+
+
+# tile geometry
+def tile_bounds(z, x, y):
+    # (west, south, east, north) of the tile
+    def lon(x):
+        return x / 2**z * 360 - 180
+
+    def lat(y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / 2**z))))
+    return lon(x), lat(y + 1), lon(x + 1), lat(y)
+
+
+def to_tile(pts, z, x, y):
+    # lon/lat to tile units (float)
+    n = 2**z
+    px = (pts[:, 0] + 180) / 360 * n
+    lat = np.radians(pts[:, 1])
+    py = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n
+    return np.column_stack([(px - x) * EXTENT, (py - y) * EXTENT])
+
+
+def clip_line(txy):
+    # the runs of the line that touch the (buffered) tile
+    # the tile is 0 to EXTENT, clients clip the buffer off
+    lo, hi = -BUFFER, EXTENT + BUFFER
+    a, b = txy[:-1], txy[1:]
+    inside = ((np.minimum(a, b) <= hi) & (np.maximum(a, b) >= lo)).all(axis=1)
+    runs = []
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], inside, [0]])))
+    for start, stop in zip(edges[::2], edges[1::2]):
+        line = np.round(txy[start:stop + 1]).astype(np.int64)
+        # drop repeated points, they are less than a tile unit apart
+        keep = np.concatenate([[True], (np.diff(line, axis=0) != 0).any(1)])
+        line = line[keep]
+        if len(line) > 1:
+            runs.append(line)
+    return runs
+
+
+def tile_epsilon(z, lat):
+    # half a tile unit, in meters
+    return 40075016.7 * np.cos(np.radians(lat)) / (2**z * EXTENT) / 2
+
+
+# layer data
+def layer_version(layer):
+    # changes whenever the data in the layer does
+    if layer == 'routes':
+        import app.analysis as analysis
+        return analysis.routes_hash()[:16]
+
+    from sqlalchemy.sql import func
+    from app.models import db, ActivityArtifact
+    import app.activities as activities
+    count, made = db.session.query(
+        func.count(ActivityArtifact.activity_id),
+        func.max(ActivityArtifact.made_date)).one()
+    made = made.strftime('%Y%m%d%H%M%S%f') if made else 0
+    return f'{activities.ARTIFACT_VERSION}-{count}-{made}'
+
+
+def _load_routes():
+    import app.analysis as analysis
+    features = []
+    for i, route in enumerate(analysis.read_routes_numpy()):
+        props = {'name': route['name'], 'route_num': i + 1}
+        features.append((i + 1, [np.asarray(ls) for ls in route['mls']],
+                         props))
+    return features
+
+
+def _load_activities():
+    # from the cached map features, they are simplified to 20m already
+    from app.models import db, Activity, ActivityArtifact
+    features = []
+    rows = (db.session.query(ActivityArtifact.features)
+            .join(Activity)
+            .order_by(ActivityArtifact.activity_id)
+            .yield_per(100))
+    for text, in rows:
+        if not text:
+            continue
+        for ft in json.loads(f'[{text}]'):
+            p = ft['properties']
+            props = {'id': p['id'], 'name': p['name'], 'route': p['route'],
+                     'on_route': p['on_route'],
+                     'distance': float(p['distance'])}
+            features.append((p['id'], [np.array(ls) for ls in
+                                       ft['geometry']['coordinates']],
+                             props))
+    return features
+
+
+def load_layer(layer, version=None):
+    # features and their bounding boxes, reloaded when the data changes
+    version = version or layer_version(layer)
+    data = _layers.get(layer)
+    if data and data['version'] == version:
+        return data
+
+    features = _load_routes() if layer == 'routes' else _load_activities()
+    boxes = np.array([[min(ls[:, 0].min() for ls in lines),
+                       min(ls[:, 1].min() for ls in lines),
+                       max(ls[:, 0].max() for ls in lines),
+                       max(ls[:, 1].max() for ls in lines)]
+                      for _, lines, _ in features]).reshape(-1, 4)
+    data = {'version': version, 'features': features, 'boxes': boxes}
+    _layers[layer] = data
+    return data
+
+
+def make_tile(layer, z, x, y, version=None):
+    from app.nb_rdp import rdp_lonlat_to_m
+
+    data = load_layer(layer, version)
+    w, s, e, n = tile_bounds(z, x, y)
+    # the buffer, in degrees
+    pad = (e - w) * BUFFER / EXTENT
+    boxes = data['boxes']
+    near = np.flatnonzero((boxes[:, 0] <= e + pad) & (boxes[:, 2] >= w - pad) &
+                          (boxes[:, 1] <= n + pad) & (boxes[:, 3] >= s - pad))
+    eps = tile_epsilon(z, (n + s) / 2)
+
+    features = []
+    for i in near:
+        _id, lines, props = data['features'][i]
+        runs = []
+        for ls in lines:
+            if eps > 1 and len(ls) > 2:
+                ls = rdp_lonlat_to_m(ls, epsilon=eps)
+            runs += clip_line(to_tile(ls, z, x, y))
+        if runs:
+            features.append((_id, runs, props))
+
+    return encode_tile({layer: features})
+
+
+def get_tile(layer, z, x, y):
+    # the tile from the disk cache, or make it and put it there.
+    # the cache is by layer version, so changed data is never served
+    if layer not in LAYERS or not (0 <= z <= MAX_ZOOM and
+                                   0 <= x < 2**z and 0 <= y < 2**z):
+        return None
+
+    version = layer_version(layer)
+    layerpath = join(dirname(relpath(__file__)), CACHE_PATH, layer)
+    tilepath = join(layerpath, version, str(z), str(x), f'{y}.pbf')
+    if os.path.exists(tilepath):
+        with open(tilepath, 'rb') as fp:
+            return fp.read()
+
+    if not os.path.exists(join(layerpath, version)):
+        # new data, the old tiles are no use now
+        shutil.rmtree(layerpath, ignore_errors=True)
+
+    tile = make_tile(layer, z, x, y, version)
+    os.makedirs(dirname(tilepath), exist_ok=True)
+    tmp = f'{tilepath}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(tile)
+    os.replace(tmp, tilepath)
+    return tile
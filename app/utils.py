@@ -1,7 +1,10 @@
 import io
+import os
 import csv
 import re
-from flask import send_file
+import gzip
+import shutil
+from flask import send_file, request, make_response
 
 
 def cvsfileify(dict_list, keys, filename):
@@ -25,3 +28,218 @@ def hashtags(line):
         line = ""
     tags = re.split('[ :!.,\'"&\\?\t\n]', line.lower())
     return set([i[1:] for i in tags if i.startswith("#")])
+
+
+# geojson in other shapes.  json is the default, geobuf is a
+# protobuf that is a fraction of the size.
+JSON_TYPE = 'application/json'
+GEOBUF_TYPE = 'application/x-protobuf'
+COMPRESS_MIN = 1024  # bytes, not worth it below this
+
+
+def geobuf_module():
+    # geobuf's generated protobuf code only loads with the pure
+    # python protobuf on 4.x, which the deploy config asks for with
+    # PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python.  None if it won't
+    # load, then there is no geobuf.
+    try:
+        import geobuf
+    except (ImportError, TypeError):
+        return None
+    return geobuf
+
+
+def brotli_module():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def accepted_encoding():
+    # the best compression the client takes that we can make
+    encodings = request.accept_encodings
+    if encodings['br'] and brotli_module():
+        return 'br'
+    if encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli_module().compress(data)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def accepted_geojson_type():
+    types = [JSON_TYPE, 'application/geo+json']
+    if geobuf_module():
+        types.append(GEOBUF_TYPE)
+    return request.accept_mimetypes.best_match(types, default=JSON_TYPE)
+
+
+def geojson_response(gj):
+    # gj as json or geobuf, compressed, whatever the client asked for
+    import geojson
+    mimetype = accepted_geojson_type()
+    if mimetype == GEOBUF_TYPE:
+        data = geobuf_module().encode(gj, 5)  # 1m, same as the json
+    else:
+        data = geojson.dumps(gj).encode()
+
+    encoding = accepted_encoding() if len(data) > COMPRESS_MIN else None
+    resp = make_response(compress(data, encoding))
+    resp.mimetype = mimetype
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept')
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def write_atomic(filepath, data):
+    tmp = filepath + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, filepath)
+
+
+def compress_file(filepath, encoding, chunk_size=1 << 20):
+    # filepath.gz or .br next to it, a chunk at a time, so a big
+    # export is never all in memory
+    suffix = {'gzip': '.gz', 'br': '.br'}[encoding]
+    tmp = filepath + suffix + '.tmp'
+    with open(filepath, 'rb') as src, open(tmp, 'wb') as dst:
+        if encoding == 'gzip':
+            with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6,
+                               mtime=0) as gz:
+                shutil.copyfileobj(src, gz, chunk_size)
+        else:
+            compressor = brotli_module().Compressor()
+            for chunk in iter(lambda: src.read(chunk_size), b''):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+    os.replace(tmp, filepath + suffix)
+    return filepath + suffix
+
+
+def write_variants(filepath, geobuf=False):
+    # next to an exported file, write the .gz and .br (if we have
+    # brotli) versions and, for geojson, a geobuf .pbf of it too.
+    # geobuf needs the whole geojson loaded, so only ask for it for
+    # the small ones.  without it an old .pbf is taken away, it would
+    # be served instead of the new export
+    paths = [filepath]
+    pbfpath = os.path.splitext(filepath)[0] + '.pbf'
+    if geobuf and geobuf_module():
+        import json
+        with open(filepath) as fp:
+            gj = json.load(fp)
+        write_atomic(pbfpath, geobuf_module().encode(gj, 5))
+        paths.append(pbfpath)
+    elif filepath.endswith('.geojson'):
+        for path in (pbfpath, pbfpath + '.gz', pbfpath + '.br'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    for path in paths:
+        compress_file(path, 'gzip')
+        if brotli_module():
+            compress_file(path, 'br')
+    return paths
+
+
+def send_variant(filepath, mimetype, etag=None, immutable=False):
+    # send the export, or its geobuf and/or precompressed version
+    # if the client takes it and it is there.  etag is the content
+    # hash, each variant gets its own tag from it
+    if (mimetype == JSON_TYPE and
+            accepted_geojson_type() == GEOBUF_TYPE and
+            filepath.endswith('.geojson')):
+        pbfpath = os.path.splitext(filepath)[0] + '.pbf'
+        if os.path.exists(pbfpath):
+            filepath, mimetype = pbfpath, GEOBUF_TYPE
+
+    encoding = accepted_encoding()
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+    if (suffix == '.br' and not os.path.exists(filepath + suffix) and
+            request.accept_encodings['gzip']):
+        encoding, suffix = 'gzip', '.gz'
+    if not (suffix and os.path.exists(filepath + suffix)):
+        encoding, suffix = None, ''
+
+    resp = send_file(filepath + suffix, mimetype=mimetype,
+                     etag=etag is None)
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.vary.add('Accept')
+    resp.vary.add('Accept-Encoding')
+    if etag:
+        ext = os.path.splitext(filepath)[1]
+        resp.set_etag(f'{etag}{ext}{suffix}')
+    if immutable:
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 365 * 24 * 3600
+        resp.cache_control.immutable = True
+    else:
+        # always check, it is a 304 if it hasn't changed
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+# content hashes of the exports, so they can have urls that never change
+MANIFEST = 'static/routes/manifest.json'
+_manifest = {'mtime': None, 'hashes': {}}
+
+
+def manifest_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), MANIFEST)
+
+
+def file_hash(filepath):
+    import hashlib
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def export_name(filename):
+    # static/routes/heatmap.json is "heatmap"
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def update_manifest(name, filepath):
+    # record the hash of a (re)written export
+    import json
+    from filelock import FileLock
+    path = manifest_path()
+    with FileLock(path + '.lock', timeout=10):
+        hashes = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                hashes = json.load(fp)
+        hashes[name] = file_hash(filepath)
+        write_atomic(path, json.dumps(hashes, indent=1).encode())
+    return hashes[name]
+
+
+def export_hash(name):
+    # the current hash of the export, None if it isn't in the manifest
+    import json
+    path = manifest_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if mtime != _manifest['mtime']:
+        with open(path) as fp:
+            _manifest['hashes'] = json.load(fp)
+        _manifest['mtime'] = mtime
+    return _manifest['hashes'].get(name)
@@ -21,6 +21,32 @@ except ImportError:
             "SUBSCRIPTION_VERIFY_TOKEN"
         SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# compile the numba kernels when the app starts, instead of on
+# the first request that needs them (they are cached on disk)
+Config.NUMBA_WARMUP = getattr(Config, 'NUMBA_WARMUP',
+                              bool(os.environ.get('NUMBA_WARMUP')))
+
+# strava api client: (connect, read) timeouts in seconds, how many times
+# to retry a 5xx/429, and keep-alive connections kept per host
+Config.STRAVA_TIMEOUT = getattr(Config, 'STRAVA_TIMEOUT', (3.05, 10))
+Config.STRAVA_RETRIES = getattr(Config, 'STRAVA_RETRIES', 3)
+Config.STRAVA_POOL_SIZE = getattr(Config, 'STRAVA_POOL_SIZE', 10)
+
+# strava's (15 minute, daily) request limits until it tells us, the
+# share of them backfills leave for webhooks, and the longest a call
+# waits for budget before giving up (seconds)
+Config.STRAVA_RATE_LIMITS = getattr(Config, 'STRAVA_RATE_LIMITS', (100, 1000))
+Config.STRAVA_RATE_RESERVE = getattr(Config, 'STRAVA_RATE_RESERVE', 0.2)
+Config.STRAVA_RATE_MAX_WAIT = getattr(Config, 'STRAVA_RATE_MAX_WAIT', 60)
+
+# webhook events wait until their activity has had no new events for
+# this long (seconds), so a burst of edits is fetched once
+Config.EVENT_COALESCE_WINDOW = getattr(Config, 'EVENT_COALESCE_WINDOW', 10)
+
+# how long browsers (and proxies) keep vector tiles before they check
+# them again (seconds)
+Config.TILE_MAX_AGE = getattr(Config, 'TILE_MAX_AGE', 3600)
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -0,0 +1,110 @@
+"""indexes, token hashes and analysis state
+
+Revision ID: 081fe47d3208
+Revises: 7a4d0e6f2c81
+Create Date: 2026-10-18 15:20:00.000000
+
+The token hash columns and activity.analysis_state, filled in from
+what is there, and the indexes the app's queries need.  every step
+checks first, so it is safe on a database "flask initdb" already made
+some of it on.
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '081fe47d3208'
+down_revision = '7a4d0e6f2c81'
+branch_labels = None
+depends_on = None
+
+
+def _inspect():
+    return sa.inspect(op.get_bind())
+
+
+def _has_index(table, columns):
+    # any index (or unique constraint) starting with these columns
+    insp = _inspect()
+    found = [ix['column_names'] for ix in insp.get_indexes(table)]
+    found += [uc['column_names'] for uc in insp.get_unique_constraints(table)]
+    return any(cols[:len(columns)] == columns for cols in found)
+
+
+def _add_column(table, column):
+    if column.name not in {c['name'] for c in _inspect().get_columns(table)}:
+        op.add_column(table, column)
+
+
+def _add_index(name, table, columns, **kwargs):
+    if not _has_index(table, columns):
+        op.create_index(name, table, columns, **kwargs)
+
+
+def _drop_index(name, table):
+    if name in {ix['name'] for ix in _inspect().get_indexes(table)}:
+        op.drop_index(name, table_name=table)
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest() if token else None
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    # athlete tokens are looked up by hash
+    _add_column('athlete', sa.Column('access_token_hash', sa.String(64)))
+    _add_column('athlete', sa.Column('refresh_token_hash', sa.String(64)))
+    athlete = sa.table('athlete', sa.column('_id'),
+                       sa.column('access_token'), sa.column('refresh_token'),
+                       sa.column('access_token_hash'),
+                       sa.column('refresh_token_hash'))
+    for _id, access, refresh in conn.execute(sa.select(
+            athlete.c._id, athlete.c.access_token, athlete.c.refresh_token)):
+        conn.execute(athlete.update().where(athlete.c._id == _id).values(
+            access_token_hash=_token_hash(access),
+            refresh_token_hash=_token_hash(refresh)))
+    _add_index('ix_athlete_access_token_hash', 'athlete',
+               ['access_token_hash'])
+    _add_index('ix_athlete_refresh_token_hash', 'athlete',
+               ['refresh_token_hash'])
+
+    # activities: analysed or not, and by athlete
+    _add_column('activity', sa.Column('analysis_state', sa.String(10)))
+    activity = sa.table('activity', sa.column('analysis'),
+                        sa.column('analysis_state'))
+    conn.execute(activity.update()
+                 .where(activity.c.analysis.isnot(None))
+                 .values(analysis_state='done'))
+    _add_index('ix_activity_analysis_state', 'activity', ['analysis_state'])
+    _add_index('ix_activity_athlete_id', 'activity', ['athlete_id'])
+
+    # webhook events: the event worker's pending bursts, and the
+    # fulltext index admin's updates.match() needs on mysql
+    _add_index('ix_strava_event_pending', 'strava_event',
+               ['state', 'object_type', 'object_id'])
+    if conn.dialect.name in ('mysql', 'mariadb'):
+        _add_index('ix_strava_event_updates', 'strava_event', ['updates'],
+                   mysql_prefix='FULLTEXT')
+
+
+def downgrade():
+    # upgrade skips an index when the columns had one already, so
+    # only the ones it made are dropped
+    for table, name in (('strava_event', 'ix_strava_event_updates'),
+                        ('strava_event', 'ix_strava_event_pending'),
+                        ('activity', 'ix_activity_athlete_id'),
+                        ('activity', 'ix_activity_analysis_state'),
+                        ('athlete', 'ix_athlete_refresh_token_hash'),
+                        ('athlete', 'ix_athlete_access_token_hash')):
+        _drop_index(name, table)
+    with op.batch_alter_table('activity') as b:
+        b.drop_column('analysis_state')
+    with op.batch_alter_table('athlete') as b:
+        b.drop_column('refresh_token_hash')
+        b.drop_column('access_token_hash')
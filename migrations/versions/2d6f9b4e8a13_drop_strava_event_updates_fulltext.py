@@ -0,0 +1,36 @@
+"""drop the strava_event.updates fulltext index
+
+Revision ID: 2d6f9b4e8a13
+Revises: 5c2e8a1f7d40
+Create Date: 2026-10-18 18:40:00.000000
+
+The admin stats read the club_stats table now, nothing searches the
+updates any more.  it was only made on mysql.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d6f9b4e8a13'
+down_revision = '5c2e8a1f7d40'
+branch_labels = None
+depends_on = None
+
+
+def _has_index(name):
+    insp = sa.inspect(op.get_bind())
+    return name in {ix['name'] for ix in insp.get_indexes('strava_event')}
+
+
+def upgrade():
+    if _has_index('ix_strava_event_updates'):
+        op.drop_index('ix_strava_event_updates', table_name='strava_event')
+
+
+def downgrade():
+    if (op.get_bind().dialect.name in ('mysql', 'mariadb') and
+            not _has_index('ix_strava_event_updates')):
+        op.create_index('ix_strava_event_updates', 'strava_event',
+                        ['updates'], mysql_prefix='FULLTEXT')
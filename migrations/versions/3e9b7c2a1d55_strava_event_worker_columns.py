@@ -0,0 +1,47 @@
+"""strava event worker columns
+
+Revision ID: 3e9b7c2a1d55
+Revises: 8c5a2d7e4f13
+Create Date: 2026-10-18 15:10:00.000000
+
+The event worker's state, processed_date and result on strava_event.
+Every step checks first, so it is safe on a database "flask initdb"
+already made them on.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e9b7c2a1d55'
+down_revision = '8c5a2d7e4f13'
+branch_labels = None
+depends_on = None
+
+
+def _columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _indexes(table):
+    return {ix['name'] for ix in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    have = _columns('strava_event')
+    for column in (sa.Column('state', sa.String(10)),
+                   sa.Column('processed_date', sa.DateTime()),
+                   sa.Column('result', sa.String(256))):
+        if column.name not in have:
+            op.add_column('strava_event', column)
+    if 'ix_strava_event_state' not in _indexes('strava_event'):
+        op.create_index('ix_strava_event_state', 'strava_event', ['state'])
+
+
+def downgrade():
+    with op.batch_alter_table('strava_event') as b:
+        b.drop_index('ix_strava_event_state')
+        b.drop_column('result')
+        b.drop_column('processed_date')
+        b.drop_column('state')
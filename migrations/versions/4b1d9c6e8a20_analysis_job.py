@@ -0,0 +1,45 @@
+"""analysis job
+
+Revision ID: 4b1d9c6e8a20
+Revises: 1f5764b18590, 90ed29eb5b91
+Create Date: 2026-10-18 14:40:00.000000
+
+The analysis queue.  merges the two older heads.  (if alembic has never
+been run on the database, "flask db stamp 1f5764b18590" and then "flask
+db stamp 90ed29eb5b91" first, the two older revisions don't match the
+tables.)  skipped when "flask initdb" already made the table.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1d9c6e8a20'
+down_revision = ('1f5764b18590', '90ed29eb5b91')
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'analysis_job' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'analysis_job',
+        sa.Column('_id', sa.Integer(), primary_key=True),
+        sa.Column('activity_id', sa.BigInteger(),
+                  sa.ForeignKey('activity._id'), nullable=False,
+                  unique=True),
+        sa.Column('state', sa.String(10)),
+        sa.Column('attempts', sa.Integer()),
+        sa.Column('error', sa.Text()),
+        sa.Column('queued_date', sa.DateTime()),
+        sa.Column('started_date', sa.DateTime()),
+        sa.Column('finished_date', sa.DateTime()),
+        sa.Column('elapsed', sa.Float()))
+    op.create_index('ix_analysis_job_state', 'analysis_job', ['state'])
+
+
+def downgrade():
+    op.drop_index('ix_analysis_job_state', table_name='analysis_job')
+    op.drop_table('analysis_job')
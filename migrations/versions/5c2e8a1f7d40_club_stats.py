@@ -0,0 +1,35 @@
+"""club stats
+
+Revision ID: 5c2e8a1f7d40
+Revises: 081fe47d3208
+Create Date: 2026-10-18 16:10:00.000000
+
+The dashboard fills the table the first time it is loaded (or run
+"flask rebuild-stats").
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2e8a1f7d40'
+down_revision = '081fe47d3208'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'club_stats',
+        sa.Column('_id', sa.String(32), primary_key=True),
+        sa.Column('activities', sa.BigInteger()),
+        sa.Column('athletes', sa.BigInteger()),
+        sa.Column('distance', sa.BigInteger()),
+        sa.Column('moving_time', sa.BigInteger()),
+        sa.Column('on_course', sa.BigInteger()),
+        sa.Column('wocblm_updates', sa.BigInteger()))
+
+
+def downgrade():
+    op.drop_table('club_stats')
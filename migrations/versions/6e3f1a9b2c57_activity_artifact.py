@@ -0,0 +1,36 @@
+"""activity artifact
+
+Revision ID: 6e3f1a9b2c57
+Revises: 4b1d9c6e8a20
+Create Date: 2026-10-18 14:50:00.000000
+
+The per-activity map features and heat points.  skipped when "flask
+initdb" already made the table.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e3f1a9b2c57'
+down_revision = '4b1d9c6e8a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'activity_artifact' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'activity_artifact',
+        sa.Column('activity_id', sa.BigInteger(),
+                  sa.ForeignKey('activity._id'), primary_key=True),
+        sa.Column('version', sa.Integer()),
+        sa.Column('last_updated', sa.DateTime()),
+        sa.Column('features', sa.Text()),
+        sa.Column('heat_points', sa.LargeBinary()))
+
+
+def downgrade():
+    op.drop_table('activity_artifact')
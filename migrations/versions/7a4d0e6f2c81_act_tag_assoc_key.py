@@ -0,0 +1,57 @@
+"""act_tag_assoc key
+
+Revision ID: 7a4d0e6f2c81
+Revises: 3e9b7c2a1d55
+Create Date: 2026-10-18 15:15:00.000000
+
+One link per activity and tag: the duplicate links go, and (tag_id,
+activity_id) becomes the primary key, the upserts in store_activities
+need it.  skipped if the table has a key already.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a4d0e6f2c81'
+down_revision = '3e9b7c2a1d55'
+branch_labels = None
+depends_on = None
+
+
+def _has_key():
+    pk = sa.inspect(op.get_bind()).get_pk_constraint('act_tag_assoc')
+    return bool(pk['constrained_columns'])
+
+
+def upgrade():
+    if _has_key():
+        return
+    conn = op.get_bind()
+    assoc = sa.table('act_tag_assoc', sa.column('tag_id'),
+                     sa.column('activity_id'))
+    links = conn.execute(
+        sa.select(assoc.c.tag_id, assoc.c.activity_id).distinct()
+        .where(assoc.c.tag_id.isnot(None),
+               assoc.c.activity_id.isnot(None))).all()
+    conn.execute(assoc.delete())
+    if links:
+        conn.execute(assoc.insert(),
+                     [dict(tag_id=t, activity_id=a) for t, a in links])
+    with op.batch_alter_table('act_tag_assoc', recreate='always') as b:
+        b.alter_column('tag_id', existing_type=sa.String(32),
+                       nullable=False)
+        b.alter_column('activity_id', existing_type=sa.BigInteger(),
+                       nullable=False)
+        b.create_primary_key('pk_act_tag_assoc', ['tag_id', 'activity_id'])
+
+
+def downgrade():
+    # the duplicates are gone for good, the key can go
+    with op.batch_alter_table('act_tag_assoc', recreate='always') as b:
+        b.drop_constraint('pk_act_tag_assoc', type_='primary')
+        b.alter_column('tag_id', existing_type=sa.String(32),
+                       nullable=True)
+        b.alter_column('activity_id', existing_type=sa.BigInteger(),
+                       nullable=True)
@@ -0,0 +1,30 @@
+"""artifact made date
+
+Revision ID: 8c5a2d7e4f13
+Revises: 6e3f1a9b2c57
+Create Date: 2026-10-18 15:00:00.000000
+
+When an activity's map artifact was made, for the tile cache.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c5a2d7e4f13'
+down_revision = '6e3f1a9b2c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = sa.inspect(op.get_bind()).get_columns('activity_artifact')
+    if 'made_date' not in {c['name'] for c in columns}:
+        op.add_column('activity_artifact',
+                      sa.Column('made_date', sa.DateTime()))
+
+
+def downgrade():
+    with op.batch_alter_table('activity_artifact') as b:
+        b.drop_column('made_date')
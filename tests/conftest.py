@@ -0,0 +1,32 @@
+# the app on a throwaway sqlite database (or TEST_DATABASE_URL)
+import os
+
+import pytest
+
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite://')
+
+
+@pytest.fixture
+def app():
+    from app import create_app
+    from app.models import db
+
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def session(app):
+    from app.models import db
+    return db.session
+
+
+@pytest.fixture
+def client(app):
+    # no strava webhook subscription check on the first request
+    app.before_first_request_funcs.clear()
+    return app.test_client()
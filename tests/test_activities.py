@@ -0,0 +1,50 @@
+import numpy as np
+
+import app.activities as activities
+import app.analysis as analysis
+import app.stats as stats
+from app.analysis_codec import encode
+from app.models import Athlete, Activity, AnalysisJob, ClubStats
+
+
+def fake_pool(items, processes=None):
+    # what analyze_polylines_parallel yields: encoded results
+    for _id, _ in items:
+        results = {'coordinates': np.zeros((2, 2)),
+                   'route_nums': np.array([4, 4]),
+                   'dist_to_rtes': np.zeros(2), 'deltas': np.zeros(2),
+                   'segments': [{'route_num': 4., 'distance': 250.,
+                                 'start': 0, 'stop': 2}]}
+        yield _id, encode(results), 250
+
+
+def add_activities(session, n=3):
+    session.add(Athlete(_id=1, firstname='a'))
+    for i in range(n):
+        session.add(Activity(_id=i, athlete_id=1, distance=1000,
+                             map_summary_polyline='abc'))
+        session.add(AnalysisJob(activity_id=i, state='queued', attempts=0))
+    session.commit()
+
+
+def test_analyze_all_finishes_the_queue(session, monkeypatch):
+    monkeypatch.setattr(analysis, 'analyze_polylines_parallel', fake_pool)
+    add_activities(session)
+
+    assert activities.analyze_all() == dict(done=3, failed=0)
+    session.expire_all()
+    assert {job.state for job in AnalysisJob.query} == {'done'}
+    assert activities.analyze_queue()['done'] == 0
+
+
+def test_analyze_new_counts_the_routes(session, monkeypatch):
+    monkeypatch.setattr(analysis, 'analyze_polylines_parallel', fake_pool)
+    add_activities(session)
+    stats.totals()
+
+    assert activities.analyze_all(all=False) == dict(done=3, failed=0)
+    session.expire_all()
+    incremental = {r._id: r.on_course for r in ClubStats.query}
+    assert incremental == {'total': 750, 'route:4': 750}
+    stats.rebuild()
+    assert {r._id: r.on_course for r in ClubStats.query} == incremental
@@ -0,0 +1,54 @@
+import numpy as np
+import polyline
+
+import app.analysis as analysis
+import app.geodesy as geodesy
+
+
+def test_indexed_distances_match_every_segment():
+    routes = analysis.read_routes_numpy()
+    index = analysis.route_segment_index(routes)
+
+    # points along (and off) the routes
+    rnd = np.random.default_rng(1)
+    verts = index['vertices']
+    pts = verts[rnd.integers(0, len(verts), 2000)]
+    pts = pts + rnd.normal(scale=0.002, size=pts.shape)
+    pts = np.ascontiguousarray(pts)
+    coslat = geodesy.cos_lat(pts)
+    ins = np.ones((len(routes), len(pts)), dtype=np.bool_)
+    for i, route in enumerate(routes):
+        ins[i] = analysis.pts_in_rectangle(pts, route['minbox'],
+                                           overscale=1.3)
+
+    brute = analysis.dist_pts_to_routes(
+        pts, coslat, ins, *analysis.flatten_routes(routes))
+    indexed = analysis.dist_pts_to_routes_indexed(
+        pts, coslat, ins, index['vertices'], index['route_leaf'],
+        index['leaf_box'], index['leaf_start'], index['leaf_segs'])
+
+    assert np.isfinite(brute).any()
+    assert np.array_equal(np.isinf(brute), np.isinf(indexed))
+    assert np.allclose(brute, indexed, rtol=0, atol=1e-9)
+    assert np.array_equal(brute.argmin(axis=0), indexed.argmin(axis=0))
+
+
+def test_analyze_polyline():
+    # the whole analysis of the test activity, with and without the index
+    routes, pts, _ = analysis.generate_test_data()
+    encoded = polyline.encode(pts[:, ::-1].tolist())
+    results, on_route = analysis.analyze_polyline(
+        encoded, routes, analysis.route_segment_index(routes))
+    brute, brute_on_route = analysis.analyze_polyline(encoded, routes)
+
+    assert np.allclose(results['coordinates'], pts, rtol=0, atol=1e-6)
+    assert np.array_equal(results['route_nums'], brute['route_nums'])
+    assert np.allclose(results['dist_to_rtes'], brute['dist_to_rtes'])
+    assert on_route == brute_on_route > 0
+
+    segs = results['segments']
+    assert {abs(s['route_num']) for s in segs} == {13, 14}
+    assert np.isclose(sum(s['distance'] for s in segs),
+                      results['deltas'].sum())
+    assert on_route == int(sum(s['distance'] for s in segs
+                               if s['route_num'] > 0))
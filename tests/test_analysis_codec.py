@@ -0,0 +1,56 @@
+import pickle
+
+import numpy as np
+
+from app.analysis_codec import encode, decode, PackedAnalysis
+
+
+def make_results(n=50):
+    rnd = np.random.default_rng(1)
+    pts = np.round(np.column_stack([-71.1 + rnd.random(n) / 100,
+                                    42.3 + rnd.random(n) / 100]), 5)
+    rtnums = np.array([0] * 10 + [3] * 30 + [0] * 10)
+    return {
+        'coordinates': pts,
+        'route_nums': rtnums,
+        'dist_to_rtes': rnd.random(n).astype(np.float32) * 100,
+        'deltas': rnd.random(n).astype(np.float32) * 10,
+        'segments': [
+            {'start': 0, 'stop': 10, 'route_num': 0., 'distance': 120.5},
+            {'start': 10, 'stop': 40, 'route_num': 3., 'distance': 900.25},
+            {'start': 40, 'stop': 50, 'route_num': 0., 'distance': 80.},
+        ],
+    }
+
+
+def test_round_trip():
+    results = make_results()
+    packed = decode(encode(results))
+    assert isinstance(packed, PackedAnalysis)
+    assert np.allclose(packed['coordinates'], results['coordinates'],
+                       atol=1e-9)
+    assert np.array_equal(packed['route_nums'], results['route_nums'])
+    assert np.allclose(packed['dist_to_rtes'], results['dist_to_rtes'])
+    assert np.allclose(packed['deltas'], results['deltas'])
+
+    segs = packed['segments']
+    assert len(segs) == 3
+    for seg, orig in zip(segs, results['segments']):
+        assert (seg['start'], seg['stop']) == (orig['start'], orig['stop'])
+        assert seg['route_num'] == orig['route_num']
+        assert seg['distance'] == orig['distance']
+        assert np.allclose(seg['coordinates'],
+                           results['coordinates'][orig['start']:orig['stop']])
+    assert packed.on_route == 900.25
+
+
+def test_encode_packed_is_the_same_blob():
+    blob = encode(make_results())
+    assert encode(decode(blob)) == blob
+    assert encode(make_results(), compress=False) != blob
+    assert decode(encode(make_results(), compress=False)).nsegs == 3
+
+
+def test_old_pickled_rows():
+    results = make_results()
+    assert decode(pickle.dumps(results))['segments'] == results['segments']
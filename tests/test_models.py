@@ -0,0 +1,44 @@
+import sqlalchemy as sa
+
+from app.models import db, upsert, Athlete, Activity, ClubStats
+
+
+def test_upsert_inserts_then_updates(session):
+    session.add(Athlete(_id=1, firstname='a'))
+    session.commit()
+    row = {'_id': 10, 'athlete_id': 1, 'name': 'one', 'start_lat': 42}
+    upsert(Activity, [row], update=['name', 'start_lat'], keep=['start_lat'])
+    session.commit()
+    assert session.get(Activity, 10).name == 'one'
+
+    # the same row again: updated, but keep columns don't take a None
+    upsert(Activity, [dict(row, name='two', start_lat=None)],
+           update=['name', 'start_lat'], keep=['start_lat'])
+    session.commit()
+    session.expire_all()
+    activity = session.get(Activity, 10)
+    assert (activity.name, activity.start_lat) == ('two', 42)
+    assert session.query(Activity).count() == 1
+
+
+def test_upsert_without_update_leaves_rows(session):
+    session.add(Athlete(_id=1, firstname='a'))
+    session.commit()
+    upsert(Athlete, [{'_id': 1, 'firstname': 'b'},
+                     {'_id': 2, 'firstname': 'c'}])
+    session.commit()
+    session.expire_all()
+    assert session.get(Athlete, 1).firstname == 'a'
+    assert session.get(Athlete, 2).firstname == 'c'
+
+
+def test_upsert_add_columns(session):
+    row = dict(_id='total', activities=2, athletes=1, distance=100,
+               moving_time=0, on_course=0, wocblm_updates=0)
+    with db.engine.begin() as conn:
+        upsert(ClubStats, [row], add=['activities', 'distance'], conn=conn)
+        upsert(ClubStats, [dict(row, distance=-30)],
+               add=['activities', 'distance'], conn=conn)
+    stats = session.execute(sa.select(ClubStats.activities,
+                                      ClubStats.distance)).one()
+    assert tuple(stats) == (4, 70)
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+from filelock import FileLock
+
+import app.ratelimit as ratelimit
+
+
+@pytest.fixture
+def budget(app, tmp_path, monkeypatch):
+    # one request per window, and no waiting for it (filelock polls
+    # with short sleeps, those are fine)
+    monkeypatch.setattr(ratelimit, 'STATE_PATH', str(tmp_path / 'rl.json'))
+    app.config['STRAVA_RATE_LIMITS'] = (1, 1000)
+    sleep = time.sleep
+
+    def no_wait(seconds):
+        assert seconds < 1, f'waited {seconds}s'
+        sleep(seconds)
+
+    monkeypatch.setattr(time, 'sleep', no_wait)
+    return app
+
+
+def test_requests_dont_wait(budget):
+    with budget.test_request_context('/'):
+        ratelimit.acquire()
+        with pytest.raises(ratelimit.RateLimited) as e:
+            ratelimit.acquire()
+    assert 0 < e.value.retry_after <= 900
+
+
+def test_the_429(budget):
+    # what a page gets when its strava call is limited
+    with budget.test_request_context('/'):
+        ratelimit.acquire()
+        with pytest.raises(ratelimit.RateLimited) as e:
+            ratelimit.acquire()
+        resp = budget.make_response(
+            budget.handle_user_exception(e.value))
+    assert resp.status_code == 429
+    assert int(resp.headers['Retry-After']) >= 1
+
+
+def test_locked_state(budget):
+    # a worker holding the state is a RateLimited (or a skipped update),
+    # not a 500
+    with FileLock(ratelimit._path() + '.lock'):
+        with budget.test_request_context('/'):
+            with pytest.raises(ratelimit.RateLimited):
+                ratelimit.acquire()
+            ratelimit.update(type('Resp', (), {
+                'status_code': 429, 'headers': {}})())
+        assert ratelimit.status()['short']['usage'] == 0
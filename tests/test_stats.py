@@ -0,0 +1,122 @@
+from datetime import datetime
+
+import numpy as np
+
+import app.activities as activities
+import app.analysis as analysis
+import app.stats as stats
+import app.strava as strava
+from app.models import Athlete, Activity, ClubStats
+
+
+def data(_id, day='2021-06-01', distance=1000.):
+    return {'id': _id, 'name': 'ride #woc', 'type': 'Ride',
+            'start_date': f'{day}T10:00:00Z', 'distance': distance,
+            'moving_time': 100, 'map': {'polyline': 'abc'}}
+
+
+def results(*routes):
+    # an analysis with one segment on each (route, distance)
+    n = 2 * len(routes)
+    return {'coordinates': np.zeros((n, 2)), 'route_nums': np.zeros(n),
+            'dist_to_rtes': np.zeros(n), 'deltas': np.zeros(n),
+            'segments': [{'route_num': float(rt), 'distance': dist,
+                          'start': 2 * i, 'stop': 2 * i + 2}
+                         for i, (rt, dist) in enumerate(routes)]}
+
+
+def snapshot(session):
+    session.expire_all()
+    return {r._id: tuple(getattr(r, c) for c in stats.COLUMNS)
+            for r in ClubStats.query}
+
+
+def analyse(monkeypatch, activity_id, *routes):
+    on_route = sum(dist for rt, dist in routes if rt > 0)
+    monkeypatch.setattr(analysis, 'analyze_polyline',
+                        lambda pl, r, i: (results(*routes), on_route))
+    activities.analyze_activity(Activity.query.get(activity_id))
+
+
+def test_incremental_matches_rebuild(session, monkeypatch):
+    monkeypatch.setattr(activities, 'gRoutes', [None])
+    monkeypatch.setattr(activities, 'gRouteIndex', [None])
+    session.add_all([Athlete(_id=i, firstname='a') for i in (1, 2, 3)])
+    session.commit()
+    assert stats.totals().activities == 0
+
+    activities.store_activities(
+        [(data(i, day=f'2021-06-0{1 + i % 3}'), 1 + i % 2)
+         for i in range(10)])
+    session.commit()
+    # a re-save that moves day, and a new athlete
+    activities.store_activities([(data(3, day='2021-06-09', distance=5e3), 2),
+                                 (data(20), 3)])
+    session.commit()
+    # never committed, never counted
+    activities.store_activities([(data(30), 3)])
+    session.rollback()
+
+    for i, title in ((1, 'x #WOCBLM'), (2, 'x')):
+        strava.handle_strava_webhook_event(
+            {'_id': i, 'object_id': 1, 'aspect_type': 'update',
+             'object_type': 'activity', 'owner_id': 1,
+             'updates': {'title': title}, 'event_time': i,
+             'subscription_id': 1})
+    session.commit()
+
+    for i in (1, 2, 3):
+        analyse(monkeypatch, i, (2, 300.), (5, 200.), (-1, 7.))
+    session.commit()
+    # analysed again, the old routes come off
+    analyse(monkeypatch, 1, (2, 100.))
+    session.commit()
+
+    incremental = snapshot(session)
+    assert incremental['total'] == (11, 3, 15000, 1100, 1100, 1)
+    assert incremental['route:2'][4] == 700
+    assert incremental['day:2021-06-09'][:3] == (1, 0, 5000)
+
+    stats.rebuild()
+    assert snapshot(session) == incremental
+    assert stats.routes() == {2: 700, 5: 400}
+
+
+def test_totals_counts_the_first_time(session):
+    session.add(Athlete(_id=1, firstname='a'))
+    session.add(Activity(_id=1, athlete_id=1, distance=10, moving_time=5,
+                         start_date=datetime(2021, 6, 1)))
+    session.commit()
+    totals = stats.totals()
+    assert (totals.activities, totals.athletes, totals.distance) == (1, 1, 10)
+    assert [d._id for d in stats.days()] == ['day:2021-06-01']
+
+
+def test_counted_in_the_commit(tmp_path, monkeypatch):
+    # on a database file, with the savepoints the workers use
+    from config import app_config
+    from app import create_app
+    from app.models import db
+
+    monkeypatch.setattr(app_config['testing'], 'SQLALCHEMY_DATABASE_URI',
+                        f"sqlite:///{tmp_path / 'app.sqlite3'}")
+    monkeypatch.setattr(activities, 'gRoutes', [None])
+    monkeypatch.setattr(activities, 'gRouteIndex', [None])
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        session = db.session
+        session.add(Athlete(_id=1, firstname='a'))
+        with session.begin_nested():
+            activities.store_activities([(data(i), 1) for i in (1, 2)])
+        session.commit()
+        for i in (1, 2):
+            with session.begin_nested():
+                analyse(monkeypatch, i, (2, 300.))
+        session.commit()
+
+        incremental = snapshot(session)
+        assert incremental['total'] == (2, 1, 2000, 200, 600, 0)
+        stats.rebuild()
+        assert snapshot(session) == incremental
+        db.session.remove()
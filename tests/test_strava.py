@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import app.activities as activities
+import app.strava as strava
+from app.models import StravaEvent
+
+
+def event(_id, object_id=5, aspect='update', updates=None, age=60):
+    return StravaEvent(
+        _id=_id, object_type='activity', object_id=object_id, owner_id=1,
+        aspect_type=aspect, updates=str(updates or {}), event_time=_id,
+        subscription_id=1, state='pending',
+        timestamp=datetime.utcnow() - timedelta(seconds=age))
+
+
+def test_coalesce_events_merges_updates():
+    ev = strava.coalesce_events([
+        event(1, aspect='create'),
+        event(2, updates={'title': 'ride', 'type': 'Ride'}),
+        event(3, updates={'title': 'ride #woc'}),
+    ])
+    assert ev._id == 3 and ev.event_time == 3
+    assert ev.aspect_type == 'update'
+    assert eval(ev.updates) == {'title': 'ride #woc', 'type': 'Ride'}
+
+
+def test_coalesce_one_event_is_itself():
+    ev = event(1)
+    assert strava.coalesce_events([ev]) is ev
+
+
+def test_pending_bursts_are_fetched_once(session, monkeypatch):
+    saved = []
+
+    def save_activity(activity_id, owner, timestamp=None, commit=True):
+        saved.append(activity_id)
+        return activity_id
+
+    monkeypatch.setattr(activities, 'save_activity', save_activity)
+    session.add_all([
+        event(1, updates={'title': 'a'}),
+        event(2, object_id=6, updates={'title': 'x #woc'}),
+        event(3, updates={'title': 'a #woc'}),
+        event(4, updates={'private': 'true'}),
+        # still settling, waits for the next run
+        event(5, object_id=7, updates={'title': 'b #woc'}, age=0),
+    ])
+    session.commit()
+
+    res = strava.process_pending_events(window=10)
+    assert (res['done'], res['coalesced'], res['failed']) == (2, 2, 0)
+    assert sorted(saved) == [5, 6]
+
+    results = {ev._id: (ev.state, ev.result) for ev in StravaEvent.query}
+    assert results[4] == ('done', 'Saved.')
+    assert results[1] == results[3] == ('done', 'Coalesced into 4')
+    assert results[5] == ('pending', None)
+
+
+def test_replay_compares_in_utc(session, monkeypatch):
+    import time
+    from app.models import Activity
+
+    fetched = []
+
+    def fetch_activity(activity_id, athlete):
+        fetched.append(activity_id)
+        return 'Not found.'
+
+    monkeypatch.setattr(activities, 'fetch_activity', fetch_activity)
+    # last_updated is naive utc, the server is not
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        saved = datetime(2021, 6, 1, 12, 0)
+        ev = event(1, updates={'title': 'a #woc'})
+        # changed on strava an hour after we saved it
+        ev.event_time = int((saved - datetime(1970, 1, 1)).total_seconds()
+                            ) + 3600
+        session.add_all([Activity(_id=5, athlete_id=1, last_updated=saved),
+                         ev])
+        session.commit()
+
+        res = activities.process_range()
+        assert (res['activities'], res['fetched']) == (1, 1)
+        assert fetched == [5]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,61 @@
+import json
+import time
+
+import requests
+
+import app.auth as auth
+import app.ratelimit as ratelimit
+import app.strava_client as strava_client
+
+
+class FakeStrava(requests.adapters.BaseAdapter):
+    # answers the token endpoint with a new token, and the api with {}
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        if request.url.endswith('/oauth/token'):
+            body = {'access_token': 'new', 'refresh_token': 'r2',
+                    'token_type': 'Bearer', 'expires_at': time.time() + 3600}
+        else:
+            body = {}
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers['Content-Type'] = 'application/json'
+        resp._content = json.dumps(body).encode()
+        resp.request, resp.url = request, request.url
+        return resp
+
+    def close(self):
+        pass
+
+
+def test_expired_token_is_refreshed_and_saved(app, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'acquire', lambda *a, **kw: None)
+    monkeypatch.setattr(ratelimit, 'update', lambda resp: None)
+    saved = []
+    monkeypatch.setattr(auth, 'strava_update_token',
+                        lambda token, **kw: saved.append((token, kw)))
+    token = {'access_token': 'old', 'refresh_token': 'r1',
+             'token_type': 'Bearer', 'expires_at': int(time.time()) - 10}
+
+    strava_client.close_session()
+    fake = FakeStrava()
+    strava_client.get_session().mount('https://', fake)
+    try:
+        resp = strava_client.request('GET', 'athlete', token=token)
+    finally:
+        strava_client.close_session()
+
+    assert resp.status_code == 200
+    refresh, call = fake.sent
+    assert refresh.url == 'https://www.strava.com/oauth/token'
+    assert 'refresh_token=r1' in refresh.body
+    assert call.url == 'https://www.strava.com/api/v3/athlete'
+    assert call.headers['Authorization'] == 'Bearer new'
+    # saved the way authlib's token_update signal did
+    (new, kw), = saved
+    assert new['access_token'] == 'new'
+    assert kw == {'refresh_token': 'r1', 'access_token': None}
@@ -0,0 +1,60 @@
+import math
+import os
+import shutil
+
+import app.analysis as analysis
+import app.tiles as tiles
+
+
+def tile_of(lon, lat, z):
+    n = 2**z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+def test_route_tile(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, 'CACHE_PATH', str(tmp_path))
+    lon, lat = analysis.read_routes_numpy()[0]['mls'][0][0]
+    x, y = tile_of(lon, lat, 14)
+    url = f'/api/tiles/routes/14/{x}/{y}.pbf'
+
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/vnd.mapbox-vector-tile'
+    assert b'routes' in resp.data
+    etag = resp.headers['ETag']
+    assert etag
+    assert resp.cache_control.public
+    assert resp.cache_control.max_age == 3600
+
+    # from the disk cache now, the same tile
+    again = client.get(url)
+    assert again.headers['ETag'] == etag and again.data == resp.data
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_no_tile(client):
+    assert client.get('/api/tiles/nope/1/0/0.pbf').status_code == 404
+    assert client.get('/api/tiles/routes/3/8/0.pbf').status_code == 404
+
+
+def test_routes_hash_is_kept(tmp_path, monkeypatch):
+    routes = os.path.join(os.path.dirname(analysis.__file__), 'static',
+                          'routes')
+    for name in analysis.route_names():
+        shutil.copy(os.path.join(routes, f'{name}.geojson'), tmp_path)
+    first = analysis.routes_hash(str(tmp_path))
+
+    def no_open(*args, **kwargs):
+        raise AssertionError('read the routes again')
+
+    # unchanged files aren't read again
+    monkeypatch.setattr(analysis, 'open', no_open, raising=False)
+    assert analysis.routes_hash(str(tmp_path)) == first
+    monkeypatch.undo()
+
+    # a changed one is
+    path = tmp_path / f'{analysis.route_names()[0]}.geojson'
+    path.write_text(path.read_text() + '\n')
+    assert analysis.routes_hash(str(tmp_path)) != first
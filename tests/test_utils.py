@@ -0,0 +1,48 @@
+import gzip
+import tracemalloc
+
+import pytest
+
+import app.utils as utils
+
+
+@pytest.fixture
+def export(tmp_path):
+    # a big geojson export, with an old geobuf version next to it
+    filepath = tmp_path / 'map.geojson'
+    with open(filepath, 'w') as fp:
+        fp.write('{"type": "FeatureCollection", "features": [\n')
+        fp.write(',\n'.join(
+            f'{{"type": "Feature", "properties": {{"id": {i}}}, '
+            f'"geometry": {{"type": "Point", "coordinates": [{i}, 0]}}}}'
+            for i in range(100000)))
+        fp.write('\n]}\n')
+    (tmp_path / 'map.pbf').write_bytes(b'old')
+    (tmp_path / 'map.pbf.gz').write_bytes(b'old')
+    return filepath
+
+
+def test_write_variants_streams(export, monkeypatch):
+    # gzip only, brotli at its best is slow on this much
+    monkeypatch.setattr(utils, 'brotli_module', lambda: None)
+    data = export.read_bytes()
+    tracemalloc.start()
+    paths = utils.write_variants(str(export))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert paths == [str(export)]
+    assert peak < len(data) / 2
+    assert gzip.decompress(export.with_suffix('.geojson.gz')
+                           .read_bytes()) == data
+    # the stale geobuf would have been served instead
+    assert not export.with_suffix('.pbf').exists()
+    assert not export.with_suffix('.pbf.gz').exists()
+
+
+def test_compress_file_brotli(tmp_path):
+    brotli = pytest.importorskip('brotli')
+    filepath = tmp_path / 'heatmap.json'
+    filepath.write_bytes(b'[1, 2, 3], ' * 10000)
+    path = utils.compress_file(str(filepath), 'br', chunk_size=1000)
+    assert brotli.decompress(open(path, 'rb').read()) == filepath.read_bytes()
@@ -3,11 +3,19 @@ import time
 # import os
 
 with requests.Session() as s:
-    for i in range(1800, 0, -1):
+    i = 1800
+    while i > 0:
         r = s.get(f'http://app.wheelsofchange.us/admin/check_event/{i}',
                   )
+        if r.status_code == 429:
+            # the server is saving the strava budget for the webhooks
+            wait = int(r.headers.get('Retry-After', 60))
+            print(f'{i}, rate limited, waiting {wait}s')
+            time.sleep(wait)
+            continue
         answer = r.text
         print(f'{i}, {answer[:50]}')
+        i -= 1
         time.sleep(.25)
 
 
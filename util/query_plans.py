@@ -0,0 +1,116 @@
+# query_plans.py
+# the query plans (and times) of the queries the app makes a lot, on a
+# made up sqlite database about the size of a busy season, without and
+# then with the indexes of migration 081fe47d3208.
+#   python util/query_plans.py [athletes] [activities] [events]
+import hashlib
+import random
+import sqlite3
+import sys
+import time
+
+# the defaults for any not given
+SIZES = [int(n) for n in sys.argv[1:4]]
+N_ATHLETES, N_ACTIVITIES, N_EVENTS = SIZES + [2000, 50000, 200000][len(SIZES):]
+
+INDEXES = [
+    'CREATE INDEX ix_athlete_access_token_hash ON athlete (access_token_hash)',
+    'CREATE INDEX ix_athlete_refresh_token_hash '
+    'ON athlete (refresh_token_hash)',
+    'CREATE INDEX ix_activity_analysis_state ON activity (analysis_state)',
+    'CREATE INDEX ix_activity_athlete_id ON activity (athlete_id)',
+    'CREATE INDEX ix_strava_event_state ON strava_event (state)',
+    'CREATE INDEX ix_strava_event_pending '
+    'ON strava_event (state, object_type, object_id)',
+]
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def make_db():
+    db = sqlite3.connect(':memory:')
+    db.executescript('''
+        CREATE TABLE athlete (_id BIGINT PRIMARY KEY, firstname TEXT,
+            access_token VARCHAR(8192), refresh_token VARCHAR(8192),
+            access_token_hash VARCHAR(64), refresh_token_hash VARCHAR(64));
+        CREATE TABLE activity (_id BIGINT PRIMARY KEY, athlete_id BIGINT,
+            name TEXT, distance INTEGER, moving_time INTEGER,
+            on_course INTEGER, analysis BLOB, analysis_state VARCHAR(10));
+        CREATE TABLE strava_event (_id INTEGER PRIMARY KEY, object_id BIGINT,
+            aspect_type VARCHAR(10), object_type VARCHAR(10),
+            owner_id BIGINT, updates TEXT, timestamp DATETIME,
+            state VARCHAR(10));
+    ''')
+    rnd = random.Random(1)
+    tokens = []
+    for i in range(N_ATHLETES):
+        a, r = ('%040x' % rnd.getrandbits(160) for _ in range(2))
+        tokens.append(r)
+        db.execute('INSERT INTO athlete VALUES (?, ?, ?, ?, ?, ?)',
+                   (i, f'a{i}', a, r, token_hash(a), token_hash(r)))
+    blob = bytes(20000)
+    db.executemany('INSERT INTO activity VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+        (i, rnd.randrange(N_ATHLETES), f'ride {i} #woc', 20000, 3600, 10000,
+         None if i % 50 == 0 else blob, None if i % 50 == 0 else 'done')
+        for i in range(N_ACTIVITIES)))
+    db.executemany(
+        'INSERT INTO strava_event VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+            (i, rnd.randrange(N_ACTIVITIES), 'update', 'activity',
+             rnd.randrange(N_ATHLETES), "{'title': 'ride #woc'}",
+             '2020-07-01 00:00:00',
+             'pending' if i > N_EVENTS - 100 else 'done')
+            for i in range(N_EVENTS)))
+    db.commit()
+    return db, tokens
+
+
+def queries(tokens, indexed):
+    token = tokens[len(tokens) // 2]
+    if indexed:
+        yield ('athlete by refresh token',
+               'SELECT _id FROM athlete WHERE refresh_token_hash = ? '
+               'AND refresh_token = ?', (token_hash(token), token))
+        yield ('activities to analyse',
+               'SELECT _id FROM activity WHERE analysis_state IS NULL', ())
+    else:
+        yield ('athlete by refresh token',
+               'SELECT _id FROM athlete WHERE refresh_token = ?', (token,))
+        yield ('activities to analyse',
+               'SELECT _id FROM activity WHERE analysis IS NULL', ())
+    yield ('activities of an athlete',
+           'SELECT _id FROM activity WHERE athlete_id = ?', (7,))
+    yield ('admin activities by athlete',
+           'SELECT _id, athlete_id FROM activity ORDER BY athlete_id', ())
+    yield ('admin distinct athletes',
+           'SELECT count(DISTINCT athlete_id) FROM activity', ())
+    yield ('pending event bursts',
+           "SELECT object_type, object_id FROM strava_event "
+           "WHERE state = 'pending' GROUP BY object_type, object_id", ())
+    yield ('pending events of a burst',
+           "SELECT _id FROM strava_event WHERE state = 'pending' "
+           "AND object_type = 'activity' AND object_id = ?", (42,))
+
+
+def run(db, tokens, indexed):
+    for name, sql, args in queries(tokens, indexed):
+        plan = '; '.join(row[-1] for row in
+                         db.execute('EXPLAIN QUERY PLAN ' + sql, args))
+        t0 = time.perf_counter()
+        for _ in range(5):
+            db.execute(sql, args).fetchall()
+        ms = (time.perf_counter() - t0) / 5 * 1000
+        print(f'  {name:28s} {ms:9.3f} ms  {plan}')
+
+
+if __name__ == '__main__':
+    db, tokens = make_db()
+    print(f'{N_ATHLETES} athletes, {N_ACTIVITIES} activities, '
+          f'{N_EVENTS} events')
+    print('before:')
+    run(db, tokens, False)
+    for sql in INDEXES:
+        db.execute(sql)
+    print('after:')
+    run(db, tokens, True)